@@ -0,0 +1,134 @@
+"""Compare the selectors and asyncio server engines.
+
+Starts server.py once per engine and connection count, opens that many
+client connections and has every client run a fixed number of request /
+response round trips. The probe request is a LOGIN for an unknown user,
+which is answered without touching bcrypt, so the numbers measure the
+engine rather than password hashing.
+
+    python bench_engines.py --connections 1000 5000 10000
+"""
+import sys
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import tempfile
+import time
+
+
+PROBE = b"LOGIN:benchmark-nobody:x\n"
+REPLY = b"LOGIN:ACKSTATUS:1\n"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(engine, port, workdir, **options):
+    """Start server.py on port and wait until it accepts connections.
+
+    options are extra config keys, overriding the defaults used here.
+    """
+    config_path = os.path.join(workdir, f"{engine}.json")
+    config = {
+        "port": port,
+        "userDatabase": os.path.join(workdir, "users.json"),
+        "engine": engine,
+        "hashWorkers": 1,
+        "logLevel": "WARNING",
+        "loginTimeout": 0,  # Probe connections never log in
+    }
+    config.update(options)
+    with open(config_path, "w") as file:
+        json.dump(config, file)
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"), config_path],
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError(f"{engine} server did not start")
+
+
+async def run_client(port, requests, latencies, connected, start):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    connected.set_result(None)
+    await start.wait()
+    for _ in range(requests):
+        sent = time.perf_counter()
+        writer.write(PROBE)
+        reply = await reader.readline()
+        if reply != REPLY:
+            raise RuntimeError(f"unexpected reply {reply!r}")
+        latencies.append(time.perf_counter() - sent)
+    writer.close()
+
+
+async def run_load(port, connections, requests):
+    latencies = []
+    start = asyncio.Event()
+    tasks = []
+    # Connect in batches so the listen backlog is not overrun
+    for first in range(0, connections, 200):
+        batch = []
+        for _ in range(first, min(first + 200, connections)):
+            connected = asyncio.get_running_loop().create_future()
+            tasks.append(asyncio.create_task(run_client(port, requests, latencies, connected, start)))
+            batch.append(connected)
+        await asyncio.gather(*batch)
+    began = time.perf_counter()
+    start.set()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - began
+    latencies.sort()
+    return {
+        "connections": connections,
+        "requests": len(latencies),
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, nargs="+", default=[1000, 5000, 10000])
+    parser.add_argument("--requests", type=int, default=10, help="round trips per connection")
+    parser.add_argument("--engines", nargs="+", default=["selectors", "asyncio"])
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for connections in args.connections:
+            for engine in args.engines:
+                port = free_port()
+                server = start_server(engine, port, workdir)
+                try:
+                    result = asyncio.run(run_load(port, connections, args.requests))
+                finally:
+                    server.terminate()
+                    server.wait()
+                result["engine"] = engine
+                results.append(result)
+                print(f"{engine:>9} {connections:>6} conns: {result['requests_per_second']:>7} req/s  "
+                      f"p50 {result['p50_ms']:>7} ms  p99 {result['p99_ms']:>7} ms")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""Micro-benchmarks for the game logic, board encoding and protocol parsing.
+
+Each benchmark times one hot function with timeit and records the best
+nanoseconds per call over several repeats. Results can be written to a JSON
+file and compared against an earlier run, flagging any benchmark that got
+slower than the threshold allows:
+
+    python bench_micro.py --output baseline.json
+    ... change something ...
+    python bench_micro.py --compare baseline.json
+
+--compare exits with status 1 when there is a regression, so it can gate CI.
+"""
+import sys
+import argparse
+import contextlib
+import io
+import json
+import platform
+import timeit
+
+import bitboard
+import client
+import codec
+import game
+import server
+
+
+class FakeConnection:
+    """Just enough of a socket for server.process_commands."""
+
+    def fileno(self):
+        return 100
+
+
+def server_parser(lines, binary=False):
+    """Return a callable that feeds lines through server.process_commands."""
+    conn = FakeConnection()
+    session = server.sessions[conn] = server.Session(conn)
+    session.authenticated = True
+    session.username = "bench"
+    if binary:
+        data = b"".join(codec.encode_text(line) for line in lines)
+    else:
+        data = "".join(f"{line}\n" for line in lines).encode()
+
+    def run():
+        session.binary = binary
+        session.inbound += data
+        server.process_commands(conn, None, None)
+        session.outbound.clear()
+    return run
+
+
+def client_parser(lines):
+    """Return a callable that runs lines through client.handle_server_message."""
+    game_state = {"username": "bench", "player_turn": False, "opposing_player": "other", "running": True}
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            for line in lines:
+                client.handle_server_message(line, game_state)
+    return run
+
+
+def benchmarks():
+    """Return {name: (callable, calls made per invocation)}."""
+    x_mask, o_mask = 0b000010001, 0b100000010  # A game in progress
+    rows = [["X", "O", " "], [" ", "X", " "], [" ", " ", "O"]]
+    room = server.Room("bench", None, "bench")
+    room.x_mask, room.o_mask = x_mask, o_mask
+    frame = codec.encode_text("BOARDSTATUS:120010002")
+    body, _ = codec.split_frame(frame)
+    commands = ["ROOMLIST:PLAYER", "PLACE:1:1", "FORFEIT", "JOIN:none:VIEWER", "CREATE:bad name!"] * 20
+    messages = [
+        "BOARDSTATUS:120010002", "PLACE:ACKSTATUS:3", "ROOMLIST:ACKSTATUS:0:Rooms available to join as PLAYER: a,b",
+        "LOGIN:ACKSTATUS:0", "BADAUTH",
+    ] * 20
+    return {
+        "bitboard.wins": (lambda: bitboard.wins(x_mask), 1),
+        "bitboard.is_full": (lambda: bitboard.is_full(x_mask, o_mask), 1),
+        "bitboard.board_string": (lambda: bitboard.board_string(x_mask, o_mask), 1),
+        "bitboard.board_index": (lambda: bitboard.board_index(x_mask, o_mask), 1),
+        "game.player_wins": (lambda: game.player_wins(game.CROSS, rows), 1),
+        "game.players_draw": (lambda: game.players_draw(rows), 1),
+        "server.Room.board_status": (room.board_status, 1),
+        "server.process_commands text": (server_parser(commands), len(commands)),
+        "server.process_commands binary": (server_parser(commands, binary=True), len(commands)),
+        "client.handle_server_message": (client_parser(messages), len(messages)),
+        "codec.encode_text BOARDSTATUS": (lambda: codec.encode_text("BOARDSTATUS:120010002"), 1),
+        "codec.decode BOARDSTATUS": (lambda: codec.decode(body), 1),
+    }
+
+
+def run_benchmarks(name_filter, repeat):
+    results = {}
+    for name, (func, calls) in benchmarks().items():
+        if name_filter and name_filter not in name:
+            continue
+        timer = timeit.Timer(func)
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat=repeat, number=number))
+        results[name] = round(best / number / calls * 1e9, 1)
+        print(f"{name:>34}: {results[name]:>10} ns/call")
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print each benchmark against the baseline. Returns the names that regressed."""
+    regressed = []
+    print(f"\n{'benchmark':>34}  {'baseline':>10}  {'now':>10}  change")
+    for name, now in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f"{name:>34}  {'-':>10}  {now:>10}  new")
+            continue
+        change = now / before - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressed.append(name)
+        print(f"{name:>34}  {before:>10}  {now:>10}  {change:+.1%}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file from an earlier --output run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="slowdown counted as a regression, as a fraction (default 0.10)")
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5, help="timing repeats; the best is kept")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.filter, args.repeat)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": results,
+            }, file, indent=4)
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+        regressed = compare(results, baseline, args.threshold)
+        if regressed:
+            print(f"\n{len(regressed)} benchmark(s) slower than the baseline by more than {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+from itertools import product
+from typing import Iterable
+
+
+__all__ = [
+    "CELLS",
+    "FULL_MASK",
+    "WIN_MASKS",
+    "cell_bit",
+    "wins",
+    "is_full",
+    "board_index",
+    "board_string",
+    "masks_from_rows",
+]
+
+
+# A board is two 9-bit masks, one per side. Cell (x, y) is bit y * 3 + x,
+# the same row-major order as the 9-character wire string.
+BOARD_SIZE = 3
+CELLS = BOARD_SIZE * BOARD_SIZE
+FULL_MASK = (1 << CELLS) - 1
+
+WIN_MASKS = (
+    0b000000111, 0b000111000, 0b111000000,  # Rows
+    0b001001001, 0b010010010, 0b100100100,  # Columns
+    0b100010001, 0b001010100,               # Diagonals
+)
+
+# _WINNING[mask] is 1 when mask contains a complete line
+_WINNING = bytes(
+    any(mask & line == line for line in WIN_MASKS) for mask in range(FULL_MASK + 1)
+)
+
+# _TERNARY[mask] is the base-3 number with a 1 digit for every set bit, so
+# _TERNARY[x_mask] + 2 * _TERNARY[o_mask] numbers every board uniquely
+_TERNARY = tuple(
+    sum(3 ** cell for cell in range(CELLS) if mask >> cell & 1) for mask in range(FULL_MASK + 1)
+)
+
+# Wire string ('0' empty, '1' X, '2' O) for every base-3 board index
+# (product() varies its last element fastest, which is cell 0's digit)
+_BOARD_STRINGS = tuple(''.join(reversed(digits)) for digits in product('012', repeat=CELLS))
+
+
+def cell_bit(x: int, y: int) -> int:
+    """Return the mask bit for the cell at column x, row y"""
+    return 1 << (y * BOARD_SIZE + x)
+
+
+def wins(mask: int) -> bool:
+    """Determines whether a side's mask contains a complete line"""
+    return _WINNING[mask] == 1
+
+
+def is_full(x_mask: int, o_mask: int) -> bool:
+    """Determines whether every cell is taken"""
+    return x_mask | o_mask == FULL_MASK
+
+
+def board_index(x_mask: int, o_mask: int) -> int:
+    """Return the base-3 index of a board, in range(3 ** 9)"""
+    return _TERNARY[x_mask] + 2 * _TERNARY[o_mask]
+
+
+def board_string(x_mask: int, o_mask: int) -> str:
+    """Return the 9-character wire representation of a board"""
+    return _BOARD_STRINGS[_TERNARY[x_mask] + 2 * _TERNARY[o_mask]]
+
+
+def masks_from_rows(rows: Iterable[Iterable[str]], cross: str = 'X', nought: str = 'O') -> tuple[int, int]:
+    """Convert a list-of-lists board into (x_mask, o_mask)"""
+    x_mask = o_mask = 0
+    bit = 1
+    for row in rows:
+        for cell in row:
+            if cell == cross:
+                x_mask |= bit
+            elif cell == nought:
+                o_mask |= bit
+            bit <<= 1
+    return x_mask, o_mask
@@ -0,0 +1,127 @@
+"""Perfect-play moves for a bot opponent, looked up in a precomputed table.
+
+Every board is numbered by bitboard.board_index(), and the table holds one
+byte per number: the cell (y * 3 + x) the side to move should take, or
+NO_MOVE for boards that are finished or cannot occur. The table is solved
+once by minimax over every position reachable from the empty board, using
+the rules in game.py, and saved to a file. The server memory-maps the file,
+so a bot move is a single byte read and every worker shares the same pages.
+
+    python bot.py bot-moves.bin      # solve and write the table
+"""
+import sys
+import argparse
+import mmap
+import os
+import time
+
+import bitboard
+import game
+
+
+__all__ = [
+    "MAGIC",
+    "NO_MOVE",
+    "TABLE_SIZE",
+    "solve",
+    "write_table",
+    "load_table",
+    "best_move",
+]
+
+
+MAGIC = b"TTTBOT01"
+NO_MOVE = 0xFF
+TABLE_SIZE = 3 ** bitboard.CELLS
+
+_table = None
+
+
+def _search(board: game.Board, player: str, placed: int, results: dict) -> int:
+    """Return the minimax score of board for player, who is to move, filling in results.
+
+    A win scores more the sooner it comes, so the bot wins as quickly as it
+    can and loses as slowly as it can.
+    """
+    index = bitboard.board_index(*bitboard.masks_from_rows(board, game.CROSS, game.NOUGHT))
+    found = results.get(index)
+    if found is not None:
+        return found[0]
+    opponent = game.NOUGHT if player == game.CROSS else game.CROSS
+    best_score = best_cell = None
+    for cell in range(bitboard.CELLS):
+        y, x = divmod(cell, bitboard.BOARD_SIZE)
+        if board[y][x] != game.EMPTY:
+            continue
+        board[y][x] = player
+        if game.player_wins(player, board):
+            score = bitboard.CELLS + 1 - placed
+        elif game.players_draw(board):
+            score = 0
+        else:
+            score = -_search(board, opponent, placed + 1, results)
+        board[y][x] = game.EMPTY
+        if best_score is None or score > best_score:
+            best_score, best_cell = score, cell
+    results[index] = (best_score, best_cell)
+    return best_score
+
+
+def solve() -> bytes:
+    """Return the move table for every board, as TABLE_SIZE bytes"""
+    results = {}
+    _search(game.create_board(), game.CROSS, 0, results)
+    table = bytearray([NO_MOVE]) * TABLE_SIZE
+    for index, (_, cell) in results.items():
+        table[index] = cell
+    return bytes(table)
+
+
+def write_table(path: str) -> int:
+    """Solve the table and write it to path. Returns the number of boards with a move"""
+    table = solve()
+    path = os.path.expanduser(path)
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(MAGIC + table)
+    os.replace(temporary, path)  # Readers never see a half-written table
+    return TABLE_SIZE - table.count(NO_MOVE)
+
+
+def load_table(path: str):
+    """Memory-map the table at path, solving and writing it first if there is none.
+
+    Call this before any fork, so that workers share the mapping.
+    """
+    global _table
+    path = os.path.expanduser(path)
+    if not os.path.exists(path):
+        write_table(path)
+    with open(path, "rb") as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(data) != len(MAGIC) + TABLE_SIZE or data[:len(MAGIC)] != MAGIC:
+        data.close()
+        raise ValueError(f"{path} is not a bot move table")
+    _table = data
+
+
+def best_move(x_mask: int, o_mask: int) -> int:
+    """Return the best cell for the side to move, or NO_MOVE if the game is over"""
+    return _table[len(MAGIC) + bitboard.board_index(x_mask, o_mask)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="file to write the table to")
+    args = parser.parse_args()
+    started = time.perf_counter()
+    try:
+        positions = write_table(args.path)
+    except OSError as e:
+        print(f"Error: cannot write {args.path}: {e}")
+        sys.exit(1)
+    print(f"Wrote moves for {positions} positions to {args.path} in {time.perf_counter() - started:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,18 @@
 import socket
 import sys
 import multiprocessing
+import codec
 
 def handle_login_response(response, game_state):
     """Handle the login response from the server."""
     if response.startswith("LOGIN:ACKSTATUS:"):
-        status = response.split(":")[2]
+        parts = response.split(":")
+        status = parts[2]
         if status == "0":
             print("Login successful.")
+            if len(parts) > 3:
+                game_state["token"] = parts[3]  # For RESUME after a dropped connection
+                print(f"Session token (for RESUME from a new client): {parts[3]}")
         elif status == "1":
             print(f"Error: User {game_state['username']} not found.")
         elif status == "2":
@@ -15,6 +20,21 @@ def handle_login_response(response, game_state):
         else:
             print("Unexpected response:", response)
 
+def handle_resume_response(response, game_state):
+    """Handle the RESUME response from the server."""
+    parts = response.split(":")
+    status = parts[2] if len(parts) > 2 else None
+    if status == "0":
+        game_state["token"] = parts[3]
+        if len(parts) > 4:
+            print(f"Resumed your game in room {parts[4]}.")
+        else:
+            print("Resumed your session.")
+    elif status == "1":
+        print("Error: Session token is invalid or has expired, please LOGIN.")
+    else:
+        print("Unexpected response:", response)
+
 def handle_register_response(response):
     """Handle the registration response from the server."""
     if response.startswith("REGISTER:ACKSTATUS:"):
@@ -60,6 +80,8 @@ def handle_create_response(response):
                 print("Error: Room already exists.")
             elif status == "3":
                 print("Error: Maximum number of rooms reached.")
+            elif status == "5":
+                print("Error: You are already playing in a room.")
             else:
                 print("Unexpected response number error:", response)
         else:
@@ -77,9 +99,44 @@ def handle_join_response(response):
             print("Error: Room is full for players.")
         elif status == "3":
             print("Error: Invalid mode.")
+        elif status == "4":
+            print("Error: You are already playing in a room.")
         else:
             print("Unexpected response:", response)
 
+def handle_quickplay_response(response, game_state):
+    """Handle the QUICKPLAY response from the server."""
+    status = response.split(":")[2]
+    if status == "0":
+        if game_state["quickplay"]:
+            print("Waiting for an opponent....")
+        else:
+            print("Left the matchmaking queue.")
+    elif status == "1":
+        print("Error: You are already in a room.")
+    elif status == "2":
+        print("Error: You are already waiting for an opponent.")
+    elif status == "3":
+        print("Error: Maximum number of rooms reached.")
+    elif status == "4":
+        print("Error: You are not waiting for an opponent.")
+    else:
+        print("Unexpected response:", response)
+
+def handle_bot_response(response):
+    """Handle the BOT response from the server."""
+    status = response.split(":")[2]
+    if status == "0":
+        print("A bot has joined your room.")
+    elif status == "1":
+        print("Error: CREATE a room first, then ask for a bot.")
+    elif status == "2":
+        print("Error: Room is full for players.")
+    elif status == "3":
+        print("Error: This server has no bots.")
+    else:
+        print("Unexpected response:", response)
+
 def handle_place_error(response):
     """Handle the PLACE response from the server."""
     if response.startswith("PLACE:ACKSTATUS:"):
@@ -88,6 +145,10 @@ def handle_place_error(response):
             print("There is already a Marker here.")
         if status=="3":
             print("Not your turn your move has been Queued")
+        if status=="4":
+            print("Too many moves queued, this one was dropped")
+        if status=="5":
+            print("The game has not started yet, wait for an opponent")
 
 def handle_begin(response, game_state):
     """Handle BEGIN message from the server."""
@@ -96,6 +157,9 @@ def handle_begin(response, game_state):
     if len(parts) == 3:
         player1 = parts[1]
         player2 = parts[2]
+        game_state["board"] = "0" * 9  # Deltas start from an empty board
+        game_state["sequence"] = 0
+        game_state["mark"] = "1" if game_state["username"] == player1 else "2"
         if game_state["username"] == player1:
             print(f"It is your turn, {player1}.")
             game_state["player_turn"] = True
@@ -135,6 +199,45 @@ def handle_place_response(response, game_state):
             print(f"It is your turn, {game_state['username']}.")
             game_state["player_turn"] = True
 
+def handle_board_delta(response, game_state, sock=None):
+    """Handle BOARDDELTA: apply the move to the last board and show it like BOARDSTATUS."""
+    parts = response.split(":")
+    if len(parts) != 4:
+        print("Unexpected response:", response)
+        return
+    sequence, cell, mark = int(parts[1]), int(parts[2]), parts[3]
+    if sequence <= game_state.get("sequence", 0):
+        return  # Already part of a snapshot
+    if sequence != game_state.get("sequence", 0) + 1:
+        # A move was missed: ask for the whole board
+        if sock is not None:
+            send_command(sock, game_state, "BOARDSYNC")
+        return
+    board = game_state.get("board", "0" * 9)
+    game_state["board"] = board[:cell] + mark + board[cell + 1:]
+    game_state["sequence"] = sequence
+    handle_place_response(f"BOARDSTATUS:{game_state['board']}", game_state)
+
+def handle_board_snapshot(response, game_state):
+    """Handle BOARDSNAPSHOT: replace the board that deltas apply to."""
+    parts = response.split(":")
+    if len(parts) != 3 or len(parts[2]) != 9:
+        print("Unexpected response:", response)
+        return
+    game_state["sequence"] = int(parts[1])
+    game_state["board"] = parts[2]
+    if game_state.get("mark"):
+        # X moves when an even number of moves have been played
+        game_state["player_turn"] = (game_state["sequence"] % 2 == 0) == (game_state["mark"] == "1")
+    board_status = parts[2].replace('1', 'X').replace('2', 'O').replace('0', ' ')
+    formatted_board = [
+        f"{board_status[0]} | {board_status[1]} | {board_status[2]}",
+        f"{board_status[3]} | {board_status[4]} | {board_status[5]}",
+        f"{board_status[6]} | {board_status[7]} | {board_status[8]}"
+    ]
+    print("\nCurrent board status:")
+    print("\n".join(formatted_board))
+
 def handle_gameend(response, game_state):
     """Handle the GAMEEND message from the server."""
     parts = response.split(":")
@@ -185,12 +288,17 @@ def handle_badauth(response):
     if response == 'BADAUTH':
         print("Error: You must be logged in to perform this action")
 
-def handle_server_message(response, game_state):
-    """Handle messages received from the server."""
+def handle_server_message(response, game_state, sock=None):
+    """Handle messages received from the server.
+
+    sock is used to ask for a board resync when a BOARDDELTA is missed.
+    """
     if response.startswith("LOGIN:"):
         handle_login_response(response, game_state)  # Pass game_state here
     elif response.startswith("REGISTER:"):
         handle_register_response(response)
+    elif response.startswith("RESUME:"):
+        handle_resume_response(response, game_state)
     elif response.startswith("ROOMLIST:"):
         handle_roomlist_response(response)
     elif response.startswith("CREATE:"):
@@ -203,6 +311,10 @@ def handle_server_message(response, game_state):
         handle_inprogress(response)
     elif response.startswith("BOARDSTATUS:"):
         handle_place_response(response, game_state)  # Pass game_state here
+    elif response.startswith("BOARDDELTA:"):
+        handle_board_delta(response, game_state, sock)
+    elif response.startswith("BOARDSNAPSHOT:"):
+        handle_board_snapshot(response, game_state)
     elif response.startswith("FORFEIT:"):
         handle_forfeit_response(response, game_state)  # Pass game_state here
     elif response.startswith("GAMEEND:"):
@@ -211,28 +323,42 @@ def handle_server_message(response, game_state):
         handle_badauth(response)
     elif response.startswith("PLACE"):
         handle_place_error(response)
+    elif response.startswith("QUICKPLAY:"):
+        handle_quickplay_response(response, game_state)
+    elif response.startswith("BOT:"):
+        handle_bot_response(response)
     else:
         print("Server says:", response)
 
 def listen_for_messages(sock, game_state):
     """Listener function to handle messages from the server."""
     buffer = ""
+    frames = bytearray()
     while True:
         try:
-            response = sock.recv(8192).decode()  # Receive data from the server
+            response = sock.recv(8192)  # Receive data from the server
             if not response:
                 print("Server has closed the connection.")
                 game_state["running"] = False  # Update the running state
                 break
 
-            buffer += response  # Add the new data to the buffer
+            if game_state["binary"]:
+                frames += response
+                parts, size = codec.split_message(frames)
+                while parts is not None:
+                    del frames[:size]
+                    handle_server_message(codec.to_text(parts), game_state, sock)
+                    parts, size = codec.split_message(frames)
+                continue
+
+            buffer += response.decode()  # Add the new data to the buffer
 
             # Process complete messages
             while '\n' in buffer:
                 # Split the buffer into complete messages
                 message, buffer = buffer.split('\n', 1)  # Split on the first newline
                 if message:
-                    handle_server_message(message, game_state)  # Handle the complete message
+                    handle_server_message(message, game_state, sock)  # Handle the complete message
 
         except Exception as e:
             print(f"Error receiving message from server: {e}")
@@ -241,6 +367,24 @@ def listen_for_messages(sock, game_state):
 
 
 
+def send_command(sock, game_state, command):
+    """Send a command in the protocol agreed with the server."""
+    if game_state["binary"]:
+        sock.sendall(codec.encode_text(command))
+    else:
+        sock.sendall(f"{command}\n".encode())
+
+def negotiate(sock, command):
+    """Send a PROTO command as text. Returns True if the server agreed."""
+    sock.sendall(f"{command}\n".encode())
+    reply = b""
+    while not reply.endswith(b"\n"):
+        data = sock.recv(1)  # Byte at a time so no binary frame is read as part of the reply
+        if not data:
+            return False
+        reply += data
+    return reply == b"PROTO:ACKSTATUS:0\n"
+
 def handle_place(sock, game_state):
     """Handle placing a marker on the board."""
     while True:
@@ -254,7 +398,7 @@ def handle_place(sock, game_state):
             if 0 <= x <= 2 and 0 <= y <= 2:
             # Ensure that coordinates are within bounds
                 # Send the PLACE message to the server in the format PLACE:<x>:<y>
-                sock.sendall(f"PLACE:{x}:{y}".encode())
+                send_command(sock, game_state, f"PLACE:{x}:{y}")
                 break
             else:
                 print("Invalid coordinates. Please enter numbers between 0 and 2.")
@@ -269,28 +413,41 @@ def handle_user_input(sock, game_state):
             username = input("Enter your username: ")
             password = input("Enter your password: ")
             game_state["username"] = username
-            sock.sendall(f"LOGIN:{username}:{password}".encode())
+            send_command(sock, game_state, f"LOGIN:{username}:{password}")
+        elif command == "RESUME":
+            if not game_state.get("token"):
+                game_state["username"] = input("Enter your username: ")
+                game_state["token"] = input("Enter your session token: ").strip()
+            send_command(sock, game_state, f"RESUME:{game_state['username']}:{game_state['token']}")
         elif command == "REGISTER":
             username = input("Enter a new username: ")
             password = input("Enter a new password: ")
-            sock.sendall(f"REGISTER:{username}:{password}".encode())
+            send_command(sock, game_state, f"REGISTER:{username}:{password}")
         elif command == "ROOMLIST":
             mode = input("Enter mode (PLAYER/VIEWER): ")
-            sock.sendall(f"ROOMLIST:{mode}".encode())
+            send_command(sock, game_state, f"ROOMLIST:{mode}")
         elif command == "CREATE":
             room_name = input("Enter the room name: ")
-            sock.sendall(f"CREATE:{room_name}".encode())
+            send_command(sock, game_state, f"CREATE:{room_name}")
         elif command == "JOIN":
             room_name = input("Enter the room name to join: ")
             mode = input("Enter mode (PLAYER/VIEWER): ")
-            sock.sendall(f"JOIN:{room_name}:{mode}".encode())
+            send_command(sock, game_state, f"JOIN:{room_name}:{mode}")
+        elif command == "QUICKPLAY":
+            game_state["quickplay"] = True
+            send_command(sock, game_state, "QUICKPLAY")  # Play the next player who asks
+        elif command == "CANCEL":
+            game_state["quickplay"] = False
+            send_command(sock, game_state, "QUICKPLAY:CANCEL")
+        elif command == "BOT":
+            send_command(sock, game_state, "BOT")  # Play a bot in the room you created
         elif command == "FORFEIT":
-            sock.sendall("FORFEIT".encode())  # Send FORFEIT message to the server
+            send_command(sock, game_state, "FORFEIT")  # Send FORFEIT message to the server
         elif command == "PLACE":
             x = input("Enter X coordinate (0-2): ").strip()
             y = input("Enter Y coordinate (0-2): ").strip()
                 # Send the PLACE message to the server in the format PLACE:<x>:<y>
-            sock.sendall(f"PLACE:{x}:{y}".encode())
+            send_command(sock, game_state, f"PLACE:{x}:{y}")
         elif command == "QUIT":
             print("Closing connection and exiting...")
             game_state["running"] = False  # Set running to False
@@ -299,8 +456,9 @@ def handle_user_input(sock, game_state):
             print("Invalid command. Please try again.")
 
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python client.py <host> <port>")
+    options = sys.argv[3:]
+    if len(sys.argv) < 3 or not set(options) <= {"--binary", "--deltas"} or len(set(options)) != len(options):
+        print("Usage: python client.py <host> <port> [--binary] [--deltas]")
         sys.exit(1)
 
     host = sys.argv[1]
@@ -315,11 +473,22 @@ def main():
     game_state["player_turn"] = False
     game_state["opposing_player"] = None
     game_state["running"] = True
+    game_state["binary"] = False
+    game_state["token"] = None
+    game_state["mark"] = None
+    game_state["quickplay"] = False
 
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.connect((host, port))
         print(f"Connected to server at {host}:{port}")
+        # Both are asked for in text, before any binary frames
+        if "--deltas" in options and not negotiate(sock, "PROTO:DELTA"):
+            print("Server did not accept board deltas, using full boards.")
+        if "--binary" in options:
+            game_state["binary"] = negotiate(sock, codec.PROTO_BINARY)
+            if not game_state["binary"]:
+                print("Server did not accept the binary protocol, using text.")
     except Exception as e:
         print(f"Failed to connect to server: {e}")
         sys.exit(1)
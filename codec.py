@@ -0,0 +1,234 @@
+import struct
+
+import bitboard
+
+
+__all__ = [
+    "MESSAGES",
+    "PROTO_BINARY",
+    "FRAME_HEADER",
+    "MAX_FRAME_LENGTH",
+    "encode",
+    "encode_text",
+    "encode_lines",
+    "decode",
+    "to_text",
+    "split_frame",
+    "split_message",
+]
+
+
+# A client that sends PROTO:BINARY as a text command, and gets back
+# PROTO:ACKSTATUS:0 (still in text), switches both directions to frames:
+#
+#     length (2 bytes, big-endian) | opcode (1 byte) | fields
+#
+# Every frame stands for one text message, so a frame can always be turned
+# back into the text form and the other way round. The exception is a
+# message too long for one frame: its UTF-8 text is cut into CONTINUED
+# frames, ended by a TEXT frame with the last piece (see split_message).
+PROTO_BINARY = "PROTO:BINARY"
+FRAME_HEADER = struct.Struct("!H")
+MAX_FRAME_LENGTH = 0xFFFF
+
+# Field kinds:
+#   s  string, 1-byte length then UTF-8
+#   i  small signed integer, 1 byte (coordinates, status codes)
+#   c  command name, sent as its opcode
+#   b  board, the X and O bitboards as two 2-byte masks
+#   *  the remaining colon-separated fields: a count byte, then each one
+#      as a 2-byte length and UTF-8
+TEXT = 0x00  # Opcode for any message without a fixed layout, sent as UTF-8
+CONTINUED = 0x0F  # A piece of a long TEXT message; the rest follows in the next frame
+ACKSTATUS = 0x10  # <command>:ACKSTATUS:<status>[:<more>...]
+MESSAGES = {
+    # Client to server
+    "LOGIN": (0x01, "ss"),
+    "REGISTER": (0x02, "ss"),
+    "ROOMLIST": (0x03, "*"),
+    "CREATE": (0x04, "s"),
+    "JOIN": (0x05, "ss"),
+    "PLACE": (0x06, "ii"),
+    "FORFEIT": (0x07, ""),
+    "BOARDSYNC": (0x08, ""),
+    "QUICKPLAY": (0x09, "*"),
+    "BOT": (0x0A, ""),
+    # Server to client
+    "BEGIN": (0x11, "ss"),
+    "INPROGRESS": (0x12, "ss"),
+    "BOARDSTATUS": (0x13, "b"),
+    "GAMEEND": (0x14, "bi*"),
+    "NOROOM": (0x15, ""),
+    "BADAUTH": (0x16, ""),
+    "BOARDDELTA": (0x17, "iii"),
+    "BOARDSNAPSHOT": (0x18, "ib"),
+}
+_NAMES = {opcode: (name, kinds) for name, (opcode, kinds) in MESSAGES.items()}
+_ACK_KINDS = "ci*"
+
+_BYTE = struct.Struct("!B")
+_SIGNED = struct.Struct("!b")
+_SHORT = struct.Struct("!H")
+_BOARD = struct.Struct("!HH")
+_FULL_CONTINUED = FRAME_HEADER.pack(MAX_FRAME_LENGTH) + _BYTE.pack(CONTINUED)
+
+
+def _pack_string(value: str, length: struct.Struct) -> bytes:
+    data = value.encode()
+    return length.pack(len(data)) + data  # struct.error if it is too long
+
+
+def _pack(opcode: int, kinds: str, fields: list) -> bytes:
+    if kinds.endswith("*"):
+        fixed, rest = fields[:len(kinds) - 1], fields[len(kinds) - 1:]
+    else:
+        fixed, rest = fields, None
+    if len(fixed) != len(kinds.rstrip("*")):
+        raise ValueError("wrong number of fields")
+    out = [_BYTE.pack(opcode)]
+    for kind, value in zip(kinds, fixed):
+        if kind == "s":
+            out.append(_pack_string(value, _BYTE))
+        elif kind == "i":
+            out.append(_SIGNED.pack(int(value)))
+        elif kind == "c":
+            out.append(_BYTE.pack(MESSAGES[value][0]))
+        elif kind == "b":
+            out.append(_BOARD.pack(*value))
+    if rest is not None:
+        out.append(_BYTE.pack(len(rest)))
+        out.extend(_pack_string(value, _SHORT) for value in rest)
+    body = b"".join(out)
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+def encode(parts) -> bytes:
+    """Encode a decoded message, as returned by decode(), as one frame"""
+    name = parts[0]
+    try:
+        if len(parts) > 1 and parts[1] == "ACKSTATUS":
+            return _pack(ACKSTATUS, _ACK_KINDS, [name] + list(parts[2:]))
+        opcode, kinds = MESSAGES[name]
+        return _pack(opcode, kinds, list(parts[1:]))
+    except (KeyError, ValueError, struct.error):
+        data = to_text(parts).encode()
+        if len(data) < MAX_FRAME_LENGTH:
+            return FRAME_HEADER.pack(len(data) + 1) + _BYTE.pack(TEXT) + data
+        out = []
+        piece = MAX_FRAME_LENGTH - 1  # Text bytes that fit in a frame after the opcode
+        last = (len(data) - 1) // piece * piece
+        for start in range(0, last, piece):
+            out.append(_FULL_CONTINUED + data[start:start + piece])
+        out.append(FRAME_HEADER.pack(len(data) - last + 1) + _BYTE.pack(TEXT) + data[last:])
+        return b"".join(out)
+
+
+def encode_text(line: str) -> bytes:
+    """Encode one text protocol message (without its newline) as a frame"""
+    parts = line.split(":")
+    kinds = MESSAGES[parts[0]][1] if parts[0] in MESSAGES else ""
+    # Boards travel as masks rather than as the 9-character string
+    for index, kind in enumerate(kinds, start=1):
+        if kind == "b" and index < len(parts) and len(parts[index]) == bitboard.CELLS:
+            parts[index] = bitboard.masks_from_rows([parts[index]], '1', '2')
+    return encode(parts)
+
+
+def encode_lines(data: bytes) -> bytes:
+    """Re-encode newline-terminated text protocol output as frames"""
+    return b"".join(encode_text(line) for line in data.decode().split("\n")[:-1])
+
+
+def decode(body: bytes) -> tuple:
+    """Decode a frame body (opcode and fields) into its message parts.
+
+    The parts are those of the text message, except that status codes and
+    coordinates are ints and boards are (x_mask, o_mask) tuples. Raises
+    ValueError for a frame that is empty, truncated or has an unknown opcode.
+    """
+    if not body:
+        raise ValueError("empty frame")
+    opcode = body[0]
+    if opcode == TEXT:
+        return tuple(body[1:].decode().split(":"))
+    if opcode == ACKSTATUS:
+        kinds = _ACK_KINDS
+    elif opcode in _NAMES:
+        name, kinds = _NAMES[opcode]
+    else:
+        raise ValueError(f"unknown opcode {opcode:#04x}")
+    fields = []
+    pos = 1
+    try:
+        for kind in kinds:
+            if kind == "s":
+                end = pos + 1 + body[pos]
+                fields.append(body[pos + 1:end].decode())
+                pos = end
+            elif kind == "i":
+                fields.append(_SIGNED.unpack_from(body, pos)[0])
+                pos += 1
+            elif kind == "c":
+                fields.append(_NAMES[body[pos]][0])
+                pos += 1
+            elif kind == "b":
+                fields.append(_BOARD.unpack_from(body, pos))
+                pos += _BOARD.size
+            elif kind == "*":
+                count = body[pos]
+                pos += 1
+                for _ in range(count):
+                    end = pos + _SHORT.size + _SHORT.unpack_from(body, pos)[0]
+                    fields.append(body[pos + _SHORT.size:end].decode())
+                    pos = end
+    except (IndexError, KeyError, struct.error):
+        raise ValueError("malformed frame") from None  # Cut short, or an unknown command opcode
+    if pos != len(body):
+        raise ValueError("malformed frame")
+    if opcode == ACKSTATUS:
+        return (fields[0], "ACKSTATUS") + tuple(fields[1:])
+    return (name,) + tuple(fields)
+
+
+def to_text(parts) -> str:
+    """Return the text protocol form of decoded message parts"""
+    return ":".join(
+        bitboard.board_string(*part) if isinstance(part, tuple) else str(part) for part in parts
+    )
+
+
+def split_frame(buffer) -> tuple:
+    """Return (body, frame size) for the first complete frame in buffer, or (None, 0)"""
+    if len(buffer) < FRAME_HEADER.size:
+        return None, 0
+    size = FRAME_HEADER.size + FRAME_HEADER.unpack_from(buffer)[0]
+    if len(buffer) < size:
+        return None, 0
+    return bytes(buffer[FRAME_HEADER.size:size]), size
+
+
+def split_message(buffer) -> tuple:
+    """Return (decoded parts, size) for the first complete message in buffer, or (None, 0).
+
+    Unlike split_frame, this joins up a message sent as CONTINUED frames.
+    Raises ValueError, as decode() does, for a malformed message.
+    """
+    pieces = []
+    pos = 0
+    while True:
+        if len(buffer) < pos + FRAME_HEADER.size:
+            return None, 0
+        end = pos + FRAME_HEADER.size + FRAME_HEADER.unpack_from(buffer, pos)[0]
+        if len(buffer) < end:
+            return None, 0
+        body = bytes(buffer[pos + FRAME_HEADER.size:end])
+        pos = end
+        if not body or body[0] != CONTINUED:
+            break
+        pieces.append(body[1:])
+    if not pieces:
+        return decode(body), pos
+    if not body or body[0] != TEXT:
+        raise ValueError("continued text not ended by a TEXT frame")
+    pieces.append(body[1:])
+    return tuple(b"".join(pieces).decode().split(":")), pos
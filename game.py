@@ -1,5 +1,7 @@
 from typing import Optional
 
+import bitboard
+
 
 __all__ = [
     "NOUGHT",
@@ -31,27 +33,6 @@ Board = list[list[str]]
 ############### Private functions—do not use! ###############
 #############################################################
 
-def _player_wins_vertically(player: str, board: Board) -> bool:
-    return any(
-        all(board[y][x] == player for y in range(BOARD_SIZE)) 
-        for x in range(BOARD_SIZE)
-    )
-
-
-def _player_wins_horizontally(player: str, board: Board) -> bool:
-    return any(
-        all(board[x][y] == player for y in range(BOARD_SIZE)) 
-        for x in range(BOARD_SIZE)
-    )
-
-
-def _player_wins_diagonally(player: str, board: Board) -> bool:
-    return (
-        all(board[y][y] == player for y in range(BOARD_SIZE)) or
-        all(board[BOARD_SIZE - 1 - y][y] == player for y in range(BOARD_SIZE))
-    )
-
-
 def _try_read_value(prompt: str) -> Optional[int]:
     try:
         value = int(input(prompt))
@@ -100,17 +81,10 @@ def player_turn(player: str, board: Board) -> tuple[int, int]:
 
 def player_wins(player: str, board: Board) -> bool:
     """Determines whether the specified player wins given the board"""
-    return (
-        _player_wins_vertically(player, board) or
-        _player_wins_horizontally(player, board) or
-        _player_wins_diagonally(player, board)
-    )
+    x_mask, o_mask = bitboard.masks_from_rows(board, CROSS, NOUGHT)
+    return bitboard.wins(x_mask if player == CROSS else o_mask)
 
 
 def players_draw(board: Board) -> bool:
     """Determines whether the players draw on the given board"""
-    return all(
-        board[y][x] != EMPTY 
-        for y in range(BOARD_SIZE) 
-        for x in range(BOARD_SIZE)
-    )
+    return bitboard.is_full(*bitboard.masks_from_rows(board, CROSS, NOUGHT))
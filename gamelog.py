@@ -0,0 +1,374 @@
+"""Append-only binary log of game events, and a memory-mapped reader for it.
+
+The server appends a CREATE, JOIN, PLACE or GAMEEND event as each happens.
+Events are buffered in memory and a background thread writes and fsyncs
+whatever has accumulated every flush interval, so many events share one
+fsync and the event loop never waits on the disk. Events from the last
+interval before a crash can be lost. A torn final event is skipped by
+readers and cut off when the log is next opened for writing, so new events
+start on an event boundary.
+
+The log starts with MAGIC, followed by events:
+
+    length (2 bytes) | kind (1 byte) | game id (8 bytes) | time (8 bytes) | fields
+
+length counts every byte after itself, so a scan can hop from event to
+event without decoding fields. Time is microseconds since the epoch.
+
+    python gamelog.py games.log                  # totals over every game
+    python gamelog.py games.log --list           # one line per game, with its id
+    python gamelog.py games.log --game <id>      # replay one game move by move
+"""
+import sys
+import argparse
+import atexit
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, NamedTuple
+
+import bitboard
+
+
+__all__ = [
+    "MAGIC",
+    "EVENTS",
+    "Event",
+    "GameRecord",
+    "new_game_id",
+    "encode_event",
+    "record",
+    "open_log",
+    "close_log",
+    "read_events",
+    "count_results",
+    "replay",
+]
+
+
+MAGIC = b"TTTGLOG1"
+HEADER = struct.Struct("!HBQQ")
+
+# Field kinds:
+#   s  string, 1-byte length then UTF-8
+#   B  unsigned byte
+#   H  unsigned 2-byte integer (a board mask)
+EVENTS = {
+    "CREATE": (1, "ss"),  # Room name, creator (player 1)
+    "JOIN": (2, "sB"),  # Username, 1 for player 2 or 0 for a viewer
+    "PLACE": (3, "BB"),  # Player (1 or 2), cell (y * 3 + x)
+    "GAMEEND": (4, "BsHH"),  # GAMEEND status code, winner ('' for none), X mask, O mask
+}
+_KINDS = {code: (name, fields) for name, (code, fields) in EVENTS.items()}
+_BYTE = struct.Struct("!B")
+_SHORT = struct.Struct("!H")
+
+logger = logging.getLogger("server.game")
+
+_writer = None
+
+
+class Event(NamedTuple):
+    kind: str
+    game_id: int
+    time: float  # Seconds since the epoch
+    fields: tuple
+
+
+def new_game_id() -> int:
+    """Return a random 63-bit game id, unique across restarts and workers"""
+    return int.from_bytes(os.urandom(8), "big") >> 1
+
+
+def encode_event(kind: str, game_id: int, fields: tuple, when: float = None) -> bytes:
+    """Encode one event, stamped with the current time unless when is given"""
+    code, kinds = EVENTS[kind]
+    out = []
+    for field_kind, value in zip(kinds, fields):
+        if field_kind == "s":
+            data = value.encode()
+            out.append(_BYTE.pack(len(data)) + data)  # struct.error if it is too long
+        elif field_kind == "B":
+            out.append(_BYTE.pack(value))
+        else:
+            out.append(_SHORT.pack(value))
+    body = b"".join(out)
+    micros = int((time.time() if when is None else when) * 1e6)
+    return HEADER.pack(HEADER.size - _SHORT.size + len(body), code, game_id, micros) + body
+
+
+def _decode_fields(kinds: str, data, pos: int) -> tuple:
+    fields = []
+    for field_kind in kinds:
+        if field_kind == "s":
+            end = pos + 1 + data[pos]
+            fields.append(bytes(data[pos + 1:end]).decode())
+            pos = end
+        elif field_kind == "B":
+            fields.append(data[pos])
+            pos += 1
+        else:
+            fields.append(_SHORT.unpack_from(data, pos)[0])
+            pos += _SHORT.size
+    return tuple(fields)
+
+
+def _end_of_events(data) -> int:
+    """Return the offset just past the last complete event in a mapped log"""
+    pos = len(MAGIC)
+    size = len(data)
+    while pos + _SHORT.size <= size:
+        end = pos + _SHORT.size + (data[pos] << 8 | data[pos + 1])
+        if end > size:
+            break
+        pos = end
+    return pos
+
+
+class _Writer:
+    """Batches events in memory and group-commits them on a background thread."""
+
+    def __init__(self, path: str, interval: float):
+        self.file = open(path, "a+b", buffering=0)
+        size = self.file.tell()
+        if size == 0:
+            self.file.write(MAGIC)
+        elif os.pread(self.file.fileno(), len(MAGIC), 0) != MAGIC:
+            self.file.close()
+            raise ValueError(f"{path} is not a game log")
+        else:
+            with _map_log(path) as data:
+                end = _end_of_events(data)
+            if end < size:
+                logger.warning("Cutting a torn event of %d byte(s) off the end of the game log", size - end)
+                self.file.truncate(end)
+        self.interval = interval
+        self.pending = bytearray()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="gamelog", daemon=True)
+        self.thread.start()
+
+    def append(self, data: bytes):
+        with self.lock:
+            self.pending += data
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.commit()
+
+    def commit(self):
+        with self.lock:
+            if not self.pending:
+                return
+            data, self.pending = self.pending, bytearray()
+        try:
+            self.file.write(data)
+            os.fsync(self.file.fileno())
+        except OSError as e:
+            logger.error("Could not write %d byte(s) to the game log: %s", len(data), e)
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+        self.commit()
+        self.file.close()
+
+
+def record(kind: str, game_id: int, *fields):
+    """Append an event to the open log. Does nothing when no log is open."""
+    if _writer is not None:
+        try:
+            _writer.append(encode_event(kind, game_id, fields))
+        except struct.error as e:
+            logger.error("Could not log %s event of game %d: %s", kind, game_id, e)
+
+
+def open_log(path: str, interval: float):
+    """Start logging events to path, committing every interval seconds.
+
+    Call this in each process that runs games, after any fork.
+    """
+    global _writer
+    close_log()
+    _writer = _Writer(os.path.expanduser(path), interval)
+    atexit.register(close_log)
+
+
+def close_log():
+    """Commit any buffered events and stop logging"""
+    global _writer
+    if _writer is not None:
+        writer, _writer = _writer, None
+        writer.close()
+
+
+@contextmanager
+def _map_log(path: str):
+    """Memory-map a log, yielding an empty bytes object for an empty file"""
+    with open(os.path.expanduser(path), "rb") as file:
+        if os.fstat(file.fileno()).st_size <= len(MAGIC):
+            yield b""
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"{path} is not a game log")
+            yield data
+
+
+def read_events(path: str, kinds=None) -> Iterator[Event]:
+    """Yield the events in a log, optionally only those whose kind is in kinds.
+
+    The file is memory-mapped and events of other kinds are skipped without
+    decoding, so scans over large logs stay fast.
+    """
+    codes = None if kinds is None else {EVENTS[kind][0] for kind in kinds}
+    with _map_log(path) as data:
+        pos = len(MAGIC)
+        size = len(data)
+        unpack = HEADER.unpack_from
+        while pos + HEADER.size <= size:
+            # Length and kind are read byte by byte: cheaper than unpacking
+            # the whole header of an event that is about to be skipped
+            end = pos + _SHORT.size + (data[pos] << 8 | data[pos + 1])
+            if end > size:
+                break  # Torn final event from a crash mid-write
+            if codes is None or data[pos + 2] in codes:
+                _, code, game_id, micros = unpack(data, pos)
+                name, field_kinds = _KINDS[code]
+                yield Event(name, game_id, micros / 1e6, _decode_fields(field_kinds, data, pos + HEADER.size))
+            pos = end
+
+
+class GameRecord:
+    """One game rebuilt from its events."""
+
+    __slots__ = ('game_id', 'room', 'player1', 'player2', 'viewers', 'moves', 'status', 'winner',
+                 'x_mask', 'o_mask', 'started', 'ended')
+
+    def __init__(self, game_id):
+        self.game_id = game_id
+        self.room = self.player1 = self.player2 = None
+        self.viewers = []
+        self.moves = []  # (player, cell, time)
+        self.status = self.winner = None  # None until GAMEEND
+        self.x_mask = self.o_mask = 0
+        self.started = self.ended = None
+
+    def apply(self, event: Event):
+        if event.kind == "CREATE":
+            self.room, self.player1 = event.fields
+            self.started = event.time
+        elif event.kind == "JOIN":
+            username, is_player = event.fields
+            if is_player:
+                self.player2 = username
+            else:
+                self.viewers.append(username)
+        elif event.kind == "PLACE":
+            player, cell = event.fields
+            self.moves.append((player, cell, event.time))
+            if player == 1:
+                self.x_mask |= 1 << cell
+            else:
+                self.o_mask |= 1 << cell
+        elif event.kind == "GAMEEND":
+            self.status, winner, self.x_mask, self.o_mask = event.fields
+            self.winner = winner or None
+            self.ended = event.time
+
+
+def replay(paths, game_id=None) -> dict:
+    """Rebuild games from one or more logs as {game id: GameRecord}, optionally only one game"""
+    games = {}
+    for path in paths:
+        for event in read_events(path):
+            if game_id is not None and event.game_id != game_id:
+                continue
+            game = games.get(event.game_id)
+            if game is None:
+                game = games[event.game_id] = GameRecord(event.game_id)
+            game.apply(event)
+    return games
+
+
+def print_game(game: GameRecord):
+    print(f"Game {game.game_id} in room {game.room!r}: {game.player1} (X) against {game.player2} (O)")
+    x_mask = o_mask = 0
+    for number, (player, cell, when) in enumerate(game.moves, start=1):
+        if player == 1:
+            x_mask |= 1 << cell
+        else:
+            o_mask |= 1 << cell
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when))
+        print(f"{number:>2}. {stamp} {'XO'[player - 1]} at ({cell % 3}, {cell // 3})  "
+              f"{bitboard.board_string(x_mask, o_mask)}")
+    results = {0: f"won by {game.winner}", 1: "drawn", 2: f"forfeited, {game.winner} wins"}
+    print(f"Result: {results.get(game.status, 'unfinished')}, board {bitboard.board_string(game.x_mask, game.o_mask)}")
+
+
+def print_list(paths):
+    for game in replay(paths).values():
+        results = {0: f"{game.winner} won", 1: "draw", 2: f"{game.winner} won by forfeit"}
+        print(f"{game.game_id} {game.room!r} {game.player1} v {game.player2}: {results.get(game.status, 'unfinished')}")
+
+
+def count_results(paths) -> tuple:
+    """Return the number of games and of games won, drawn and forfeited.
+
+    Only the kind byte of each event and the status byte of each GAMEEND
+    are read, which makes this several times faster than read_events().
+    """
+    create, gameend = EVENTS["CREATE"][0], EVENTS["GAMEEND"][0]
+    games = 0
+    results = [0, 0, 0]
+    for path in paths:
+        with _map_log(path) as data:
+            pos = len(MAGIC)
+            size = len(data)
+            while pos + HEADER.size <= size:
+                end = pos + _SHORT.size + (data[pos] << 8 | data[pos + 1])
+                if end > size:
+                    break
+                code = data[pos + 2]
+                if code == create:
+                    games += 1
+                elif code == gameend and data[pos + HEADER.size] < len(results):
+                    results[data[pos + HEADER.size]] += 1
+                pos = end
+    return games, results
+
+
+def print_totals(paths):
+    started = time.perf_counter()
+    games, results = count_results(paths)
+    elapsed = time.perf_counter() - started
+    print(f"{games} games: {results[0]} won, {results[1]} drawn, {results[2]} forfeited, "
+          f"{games - sum(results)} unfinished (read in {elapsed:.2f} s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="game log files (one per worker in multi-worker mode)")
+    parser.add_argument("--game", type=int, help="replay the game with this id")
+    parser.add_argument("--list", action="store_true", help="list every game")
+    args = parser.parse_args()
+    if args.list:
+        print_list(args.paths)
+        return
+    if args.game is None:
+        print_totals(args.paths)
+        return
+    games = replay(args.paths, args.game)
+    if not games:
+        print(f"Error: no game {args.game} in the log")
+        sys.exit(1)
+    print_game(games[args.game])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""Drive many concurrent games against server.py and report latencies.
+
+Every game registers and logs in two players (and any viewers) under fresh
+usernames, creates a room, joins it and plays it out to GAMEEND. The tool
+reports throughput and p50/p99/p999 latency for each command, and for
+BOARDSTATUS delivery: the time from a PLACE being sent until the resulting
+board reaches the opponent and each viewer.
+
+Without --port a server is started on a free localhost port with the
+SQLite user store and cheap (--bcrypt-rounds) password hashes, and stopped
+afterwards:
+
+    python loadgen.py --games 500 --viewers 2 --policy random
+
+With --port the games run against a server that is already listening on
+localhost. Its maxRooms must allow --games rooms at once.
+"""
+import sys
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+import uuid
+
+from bench_engines import free_port, start_server
+
+
+HOST = "127.0.0.1"
+PASSWORD = "loadgen"
+COMMANDS = ("REGISTER", "LOGIN", "CREATE", "JOIN", "PLACE")
+DELIVERY = "BOARDSTATUS delivery"
+
+
+class Client:
+    """One connection. Lines are timestamped as they arrive."""
+
+    def __init__(self, reader, writer, latencies):
+        self.reader = reader
+        self.writer = writer
+        self.latencies = latencies
+        self.lines = asyncio.Queue()
+        self.reading = asyncio.create_task(self.read_lines())
+
+    async def read_lines(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                await self.lines.put((time.perf_counter(), None))
+                return
+            await self.lines.put((time.perf_counter(), line.decode().rstrip("\n")))
+
+    async def next_line(self):
+        """Return the arrival time and text of the next message from the server."""
+        arrived, line = await self.lines.get()
+        if line is None:
+            raise ConnectionError("server closed the connection")
+        return arrived, line
+
+    async def request(self, command, expect=":ACKSTATUS:0"):
+        """Send a command and time its first reply, which must contain expect."""
+        sent = time.perf_counter()
+        self.writer.write(f"{command}\n".encode())
+        arrived, reply = await self.next_line()
+        if expect not in reply:
+            raise RuntimeError(f"{command!r} got {reply!r}")
+        self.latencies[command.split(":")[0]].append(arrived - sent)
+        return reply
+
+    async def sign_in(self, username):
+        await self.request(f"REGISTER:{username}:{PASSWORD}")
+        await self.request(f"LOGIN:{username}:{PASSWORD}")
+
+    def close(self):
+        self.reading.cancel()
+        self.writer.close()
+
+
+def choose_move(board, policy, rng):
+    """Pick a free cell of a 9-character board string, as (x, y)."""
+    free = [cell for cell in range(9) if board[cell] == "0"]
+    cell = rng.choice(free) if policy == "random" else free[0]
+    return cell % 3, cell // 3
+
+
+async def play_game(game, run_id, args, latencies, results):
+    rng = random.Random(args.seed * 1000003 + game)
+    clients = []
+    try:
+        for _ in range(2 + args.viewers):
+            reader, writer = await asyncio.open_connection(HOST, args.port)
+            clients.append(Client(reader, writer, latencies))
+        player1, player2, viewers = clients[0], clients[1], clients[2:]
+        await asyncio.gather(*(
+            client.sign_in(f"lg{run_id}g{game}c{index}") for index, client in enumerate(clients)
+        ))
+
+        room_name = f"lg{run_id}-{game}"
+        await player1.request(f"CREATE:{room_name}")
+        for viewer in viewers:
+            await viewer.request(f"JOIN:{room_name}:VIEWER")
+            await viewer.next_line()  # INPROGRESS
+        await player2.request(f"JOIN:{room_name}:PLAYER")
+        await player2.next_line()  # BEGIN
+        await player1.next_line()  # BEGIN
+        for viewer in viewers:
+            await viewer.next_line()  # INPROGRESS
+
+        board = "0" * 9
+        mover, waiter = player1, player2
+        while True:
+            x, y = choose_move(board, args.policy, rng)
+            sent = time.perf_counter()
+            mover.writer.write(f"PLACE:{x}:{y}\n".encode())
+            arrived, reply = await mover.next_line()
+            if not reply.startswith(("BOARDSTATUS:", "GAMEEND:")):
+                raise RuntimeError(f"PLACE:{x}:{y} got {reply!r}")
+            latencies["PLACE"].append(arrived - sent)
+            for other in [waiter] + viewers:
+                arrived, line = await other.next_line()
+                if line != reply:
+                    raise RuntimeError(f"expected {reply!r}, got {line!r}")
+                latencies[DELIVERY].append(arrived - sent)
+            board = reply.split(":")[1]
+            if reply.startswith("GAMEEND:"):
+                break
+            mover, waiter = waiter, mover
+        results["games"] += 1
+    except (OSError, RuntimeError) as e:
+        results["errors"] += 1
+        if results["errors"] <= 5:
+            print(f"Game {game} failed: {e}", file=sys.stderr)
+    finally:
+        for client in clients:
+            client.close()
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+async def run_load(args):
+    latencies = {name: [] for name in COMMANDS + (DELIVERY,)}
+    results = {"games": 0, "errors": 0}
+    run_id = uuid.uuid4().hex[:6]
+    limit = asyncio.Semaphore(args.concurrency or args.games)
+
+    async def limited(game):
+        async with limit:
+            await play_game(game, run_id, args, latencies, results)
+
+    began = time.perf_counter()
+    await asyncio.gather(*(limited(game) for game in range(args.games)))
+    elapsed = time.perf_counter() - began
+
+    report = {
+        "games": results["games"],
+        "failed_games": results["errors"],
+        "connections": args.games * (2 + args.viewers),
+        "seconds": round(elapsed, 3),
+        "games_per_second": round(results["games"] / elapsed, 1),
+        "latency": {},
+    }
+    for name, values in latencies.items():
+        if not values:
+            continue
+        values.sort()
+        report["latency"][name] = {
+            "count": len(values),
+            "per_second": round(len(values) / elapsed, 1),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+            "p999_ms": round(percentile(values, 0.999) * 1000, 2),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--games", type=int, default=100, help="games to play")
+    parser.add_argument("--viewers", type=int, default=0, help="viewers per room")
+    parser.add_argument("--policy", choices=["scripted", "random"], default="scripted",
+                        help="scripted takes the first free cell, random a random one")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the random policy")
+    parser.add_argument("--concurrency", type=int, default=0,
+                        help="games in flight at once (default: all of them)")
+    parser.add_argument("--port", type=int, help="use the server already listening on this localhost port")
+    parser.add_argument("--engine", default="selectors", help="engine of the server started without --port")
+    parser.add_argument("--hash-workers", type=int, default=4, help="hashWorkers of the server started without --port")
+    parser.add_argument("--bcrypt-rounds", type=int, default=4,
+                        help="bcryptRounds of the server started without --port (the server default is 12)")
+    parser.add_argument("--output", help="also write the report to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        server = None
+        if args.port is None:
+            args.port = free_port()
+            server = start_server(
+                args.engine, args.port, workdir,
+                userStorage="sqlite",
+                userDatabase=os.path.join(workdir, "users.db"),
+                hashWorkers=args.hash_workers,
+                bcryptRounds=args.bcrypt_rounds,
+                maxRooms=max(args.games, 1),
+            )
+        try:
+            report = asyncio.run(run_load(args))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    print(f"{report['games']} games ({report['failed_games']} failed) over {report['connections']} connections "
+          f"in {report['seconds']} s, {report['games_per_second']} games/s")
+    for name, stats in report["latency"].items():
+        print(f"{name:>20}: {stats['count']:>7} ({stats['per_second']:>8}/s)  p50 {stats['p50_ms']:>8} ms  "
+              f"p99 {stats['p99_ms']:>8} ms  p999 {stats['p999_ms']:>8} ms")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+from typing import Optional
+
+
+__all__ = [
+    "start_cpu",
+    "stop_cpu",
+    "toggle_cpu",
+    "start_memory",
+    "snapshot_memory",
+    "stop_memory",
+    "start_or_snapshot_memory",
+]
+
+
+# Nothing here is installed until profiling is started: the loop runs
+# unprofiled and untraced otherwise, so there is no cost while it is off.
+TOP_ENTRIES = 40
+TRACE_FRAMES = 10
+
+_profiler = None
+_previous_snapshot = None
+_reports_written = 0
+
+
+def _report_path(directory: str, kind: str, suffix: str) -> str:
+    global _reports_written
+    _reports_written += 1  # Keeps reports written within the same second apart
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    name = f"profile-{kind}-{os.getpid()}-{stamp}-{_reports_written}{suffix}"
+    return os.path.join(os.path.expanduser(directory), name)
+
+
+def start_cpu() -> bool:
+    """Start profiling the calling thread. Returns False if already profiling"""
+    global _profiler
+    if _profiler is not None:
+        return False
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+    return True
+
+
+def stop_cpu(directory: str) -> Optional[str]:
+    """Stop profiling and write the report. Returns its path, or None if not profiling.
+
+    The report lists the top functions by cumulative and by own time. The
+    raw stats are saved next to it with a .prof suffix for pstats or snakeviz.
+    """
+    global _profiler
+    if _profiler is None:
+        return None
+    _profiler.disable()
+    profiler, _profiler = _profiler, None
+    path = _report_path(directory, "cpu", ".txt")
+    profiler.dump_stats(path[:-len(".txt")] + ".prof")
+    text = io.StringIO()
+    stats = pstats.Stats(profiler, stream=text)
+    text.write("Top functions by cumulative time\n")
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_ENTRIES)
+    text.write("\nTop functions by own time\n")
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(TOP_ENTRIES)
+    with open(path, "w") as file:
+        file.write(text.getvalue())
+    return path
+
+
+def toggle_cpu(directory: str) -> str:
+    """Start profiling, or stop it and write the report. Returns what happened"""
+    if start_cpu():
+        return "CPU profiling started"
+    return f"CPU profile written to {stop_cpu(directory)}"
+
+
+def start_memory() -> bool:
+    """Start tracing allocations. Returns False if already tracing"""
+    global _previous_snapshot
+    if tracemalloc.is_tracing():
+        return False
+    _previous_snapshot = None
+    tracemalloc.start(TRACE_FRAMES)
+    return True
+
+
+def snapshot_memory(directory: str) -> Optional[str]:
+    """Write the top allocation sites. Returns the report path, or None if not tracing.
+
+    After the first snapshot, the report also lists what grew most since
+    the previous one.
+    """
+    global _previous_snapshot
+    if not tracemalloc.is_tracing():
+        return None
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"Traced memory: {current} bytes now, {peak} bytes at peak", "", "Top allocation sites"]
+    lines.extend(str(stat) for stat in snapshot.statistics("lineno")[:TOP_ENTRIES])
+    if _previous_snapshot is not None:
+        lines += ["", "Largest changes since the previous snapshot"]
+        lines.extend(str(stat) for stat in snapshot.compare_to(_previous_snapshot, "lineno")[:TOP_ENTRIES])
+    _previous_snapshot = snapshot
+    path = _report_path(directory, "memory", ".txt")
+    with open(path, "w") as file:
+        file.write("\n".join(lines) + "\n")
+    return path
+
+
+def stop_memory() -> bool:
+    """Stop tracing allocations. Returns False if not tracing"""
+    global _previous_snapshot
+    if not tracemalloc.is_tracing():
+        return False
+    tracemalloc.stop()
+    _previous_snapshot = None
+    return True
+
+
+def start_or_snapshot_memory(directory: str) -> str:
+    """Start tracing allocations, or write a snapshot if already tracing. Returns what happened"""
+    if start_memory():
+        return "Allocation tracing started"
+    return f"Allocation snapshot written to {snapshot_memory(directory)}"
@@ -4,14 +4,203 @@ import json
 import bcrypt
 import selectors
 import os
-from typing import List
+import queue
+import hashlib
+import hmac
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import re
+import asyncio
+import logging
+import signal
+import struct
+import zlib
+import time
+from itertools import count
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from functools import lru_cache
+import bitboard
+import bot
+import codec
+import gamelog
+import metrics
+import profiling
+import serverlog
+import timerwheel
+from userstore import open_user_store
+
+
+logger = logging.getLogger("server")
+connection_log = logging.getLogger("server.connection")
+auth_log = logging.getLogger("server.auth")
+room_log = logging.getLogger("server.room")
+game_log = logging.getLogger("server.game")
+worker_log = logging.getLogger("server.worker")
+metrics_log = logging.getLogger("server.metrics")
+profile_log = logging.getLogger("server.profile")
+
+MAX_COMMAND_LENGTH = 8192
+MAX_BUFFERED_INPUT = 64 * 1024
+ROOMLIST_PAGE_SIZE = 50
+LOOP_TICK = 1.0  # Seconds between loop lag measurements
+TIMER_TICK = 0.1  # Resolution of login deadlines, idle checks, turn clocks and held seats
+SCRAPE_TIMEOUT = 10.0  # Seconds a metrics scraper has to send its request and read the response
+COMMANDS = ('LOGIN', 'REGISTER', 'PROTO', 'CREATE', 'ROOMLIST', 'PLACE', 'FORFEIT', 'JOIN', 'BOARDSYNC', 'RESUME',
+            'QUICKPLAY', 'BOT', 'STATS', 'PROFILE')
+MATCHMAKER = 0  # Worker that runs the QUICKPLAY queue in multi-process mode
+BOT_USERNAME = "bot"
+
+
+
+class Room:
+    """State of one game room."""
+
+    __slots__ = (
+        'name', 'player1', 'player2', 'player1_username', 'player2_username',
+        'viewers', 'x_mask', 'o_mask', 'current_turn', 'move_queues', 'game_id', 'turn_timer',
+    )
+
+    def __init__(self, name, player1, player1_username):
+        self.name = name
+        self.player1 = player1
+        self.player1_username = player1_username
+        self.player2 = None  # Will be assigned later
+        self.player2_username = None  # Will be assigned later
+        self.viewers = []
+        self.x_mask = 0  # Bitboards of the X and O cells, empty to start
+        self.o_mask = 0
+        self.current_turn = player1  # Track whose turn it is (starts with player1)
+        self.move_queues = {}  # Player -> deque of (x, y) moves sent out of turn
+        self.game_id = gamelog.new_game_id()  # Identifies the game in the game log
+        self.turn_timer = None  # Forfeits the game for current_turn when turnTimeout runs out
+
+    @property
+    def players(self):
+        return 1 if self.player2 is None else 2
+
+    def board_status(self):
+        """Return the 9-character board string."""
+        return bitboard.board_string(self.x_mask, self.o_mask)
+
+    def sequence(self):
+        """Return the number of moves played, which numbers BOARDDELTA messages."""
+        return bin(self.x_mask | self.o_mask).count("1")
+
+
+class Bot:
+    """Stands in for the connection of a bot in the player 2 seat.
+
+    It has no session, so nothing is ever sent to it; its moves are looked
+    up in the bot table as soon as its turn comes (see handle_place_message).
+    """
+
+    __slots__ = ()
+
+
+class Session:
+    """State of one client connection. Dropped as a whole when it closes."""
+
+    __slots__ = (
+        'conn', 'username', 'authenticated', 'inbound', 'outbound',
+        'room_name', 'role', 'paused', 'resume', 'lagging', 'binary', 'deltas',
+        'timer', 'last_active', 'scrape', 'close_when_sent',
+    )
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.username = None
+        self.authenticated = False
+        self.inbound = bytearray()  # Unprocessed input
+        self.outbound = bytearray()  # Output not yet accepted by the socket
+        self.room_name = None
+        self.role = None  # 'player1', 'player2' or 'viewer' in room_name
+        self.paused = False  # Waiting on a hash job
+        self.resume = None  # How to carry on reading once the job is done
+        self.lagging = False  # Past the high-water mark, closed at the next flush
+        self.binary = False  # Speaks binary frames (see codec) instead of text lines
+        self.deltas = False  # Gets BOARDDELTA for each move instead of BOARDSTATUS
+        self.timer = None  # Login deadline until authenticated, then the idle check
+        self.last_active = time.monotonic()  # When the client last sent anything
+        self.scrape = False  # A metrics scrape rather than a game client
+        self.close_when_sent = False  # Closed once its output is out (a scrape that has been answered)
 
 
 # Global variable to track rooms
 rooms = {}
-authenticated_clients = {}
-client_usernames = {}
+sessions = {}  # Connection -> Session
+pending_writes = set()  # Connections with output queued since the last flush
+outbound_high_water = 256 * 1024
+max_rooms = 256
+max_queued_moves = 8
+bcrypt_rounds = 12
+admin_users = set()  # Usernames allowed to run STATS and PROFILE
+profile_directory = '.'
+pending_registrations = set()
+
+# QUICKPLAY pairs each player with the one who has waited longest, in a room
+# made for them. Since an arrival is paired whenever anyone is waiting, at
+# most one player waits at a time; popping the oldest and cancelling are
+# both O(1) whatever the length.
+quickplay_queue = OrderedDict()  # Username -> connection, longest waiting first
+quickplay_numbers = count(1)  # Numbers the names of QUICKPLAY rooms
+# With a bot table loaded, BOT fills a waiting room's second seat with a bot,
+# and a player left waiting in the QUICKPLAY queue for quickplay_bot_delay
+# seconds (if set) is given a bot instead.
+bots_enabled = False
+quickplay_bot_delay = 0
+quickplay_bot_timer = None
+
+# Names listed by ROOMLIST for each mode, local and remote rooms alike, kept
+# up to date as rooms are created, filled and deleted. Dicts are used as
+# insertion-ordered sets; the sorted lists page through the same names in
+# name order, so a prefix is a bisected range.
+room_index = {'PLAYER': {}, 'VIEWER': {}}
+sorted_room_names = {'PLAYER': [], 'VIEWER': []}
+roomlist_cache = {'PLAYER': {}, 'VIEWER': {}}  # Mode as sent -> encoded full reply
+
+# Multi-process mode: every worker process accepts on the same port and owns
+# the rooms whose name hashes to it. See run_workers.
+worker_id = 0
+worker_count = 1
+peer_sockets = {}  # Worker id -> SOCK_SEQPACKET socket to that worker
+peer_outbound = {}  # Peer socket -> messages waiting for it to become writable
+remote_rooms = {}  # Rooms owned by other workers -> player count, for ROOMLIST
+peer_selector = None  # The loop's selector, also used by timers that close connections; None under asyncio
+peer_message_size = 0
+
+# LOGIN hands out a signed, expiring token; RESUME with it authenticates a new
+# connection without bcrypt. A player whose connection drops keeps their seat
+# for resume_grace seconds, so they can RESUME into their game before it is
+# forfeited. The secret is made at import, before workers fork, so every
+# worker accepts every worker's tokens. Restarting the server voids them.
+token_secret = os.urandom(32)
+token_ttl = 3600
+resume_grace = 30
+detached_players = {}  # Username -> [(expiry timer, room name, dropped connection)], oldest first
+remote_detached = {}  # Username -> worker holding a seat for them
+
+# Every deadline is a timer on one wheel, which the event loop advances
+# between events: a connection that has not logged in within login_timeout
+# seconds, or has sent nothing for idle_timeout seconds, is closed, and a
+# player who takes longer than turn_timeout seconds over a move forfeits.
+# 0 turns each off.
+timers = timerwheel.TimerWheel(TIMER_TICK)
+login_timeout = 30
+idle_timeout = 600
+turn_timeout = 0
+
+# Password hashing runs on a worker pool so bcrypt never blocks the selector loop.
+# Finished jobs are queued here and the loop is woken through a socket pair.
+hash_pool = None
+completed_hash_jobs = queue.SimpleQueue()
+hash_wakeup_reader = None
+hash_wakeup_writer = None
+
+# The selector loop's signal handlers do nothing themselves: the signal
+# number also goes down this socket pair, and the loop acts on it between
+# events (see run_signals), never halfway through logging or a queue update.
+signal_wakeup_reader = None
+signal_wakeup_writer = None
 
 def load_config(config_path):
     """Load server configuration from the provided config file."""
@@ -35,499 +224,1912 @@ def load_config(config_path):
     if not isinstance(port, int) or not (1024 <= port <= 65535):
         print("Error: port number out of range")
         sys.exit(1)
+    hash_workers = config.setdefault('hashWorkers', 4)
+    if not isinstance(hash_workers, int) or hash_workers < 1:
+        print("Error: hashWorkers must be a positive integer")
+        sys.exit(1)
+    high_water = config.setdefault('outboundHighWater', 256 * 1024)
+    if not isinstance(high_water, int) or high_water < 1:
+        print("Error: outboundHighWater must be a positive integer")
+        sys.exit(1)
+    rounds = config.setdefault('bcryptRounds', 12)
+    if not isinstance(rounds, int) or not (4 <= rounds <= 31):
+        print("Error: bcryptRounds must be an integer from 4 to 31")
+        sys.exit(1)
+    queue_limit = config.setdefault('maxQueuedMoves', 8)
+    if not isinstance(queue_limit, int) or queue_limit < 0:
+        print("Error: maxQueuedMoves must be a non-negative integer")
+        sys.exit(1)
+    room_limit = config.setdefault('maxRooms', 256)
+    if not isinstance(room_limit, int) or room_limit < 1:
+        print("Error: maxRooms must be a positive integer")
+        sys.exit(1)
+    if config.setdefault('userStorage', 'json') not in ('json', 'sqlite'):
+        print("Error: userStorage must be 'json' or 'sqlite'")
+        sys.exit(1)
+    migrate_from = config.setdefault('userMigrateFrom', None)
+    if migrate_from is not None:
+        if not isinstance(migrate_from, str):
+            print("Error: userMigrateFrom must be a file path")
+            sys.exit(1)
+        if config['userStorage'] != 'sqlite':
+            print("Error: userMigrateFrom needs userStorage 'sqlite'")
+            sys.exit(1)
+        # The import only runs into a new database, so the file must be there for it
+        if (not os.path.exists(os.path.expanduser(config['userDatabase']))
+                and not os.path.isfile(os.path.expanduser(migrate_from))):
+            print(f"Error: userMigrateFrom file {migrate_from} doesn't exist.")
+            sys.exit(1)
+    log_level = config.setdefault('logLevel', 'INFO')
+    if not isinstance(logging.getLevelName(log_level), int):
+        print("Error: logLevel must be one of DEBUG, INFO, WARNING, ERROR")
+        sys.exit(1)
+    category_levels = config.setdefault('logLevels', {})
+    if not isinstance(category_levels, dict) or not all(
+            category in serverlog.CATEGORIES and isinstance(logging.getLevelName(level), int)
+            for category, level in category_levels.items()):
+        print(f"Error: logLevels must map categories ({', '.join(serverlog.CATEGORIES)}) to log levels")
+        sys.exit(1)
+    if config.setdefault('logFormat', 'text') not in serverlog.FORMATS:
+        print("Error: logFormat must be 'text' or 'json'")
+        sys.exit(1)
+    rate_limit = config.setdefault('logRateLimit', 10)
+    if not isinstance(rate_limit, int) or rate_limit < 0:
+        print("Error: logRateLimit must be a non-negative integer")
+        sys.exit(1)
+    engine = config.setdefault('engine', 'selectors')
+    if engine not in ('selectors', 'asyncio'):
+        print("Error: engine must be 'selectors' or 'asyncio'")
+        sys.exit(1)
+    workers = config.setdefault('workers', 1)
+    if not isinstance(workers, int) or workers < 1:
+        print("Error: workers must be a positive integer")
+        sys.exit(1)
+    if workers > 1 and config['userStorage'] != 'sqlite':
+        print("Error: workers > 1 requires userStorage 'sqlite' so all workers share users")
+        sys.exit(1)
+    if workers > 1 and engine != 'selectors':
+        print("Error: workers > 1 is only supported by the selectors engine")
+        sys.exit(1)
+    if workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        print("Error: workers > 1 needs SO_REUSEPORT, which this platform lacks")
+        sys.exit(1)
+    admins = config.setdefault('adminUsers', [])
+    if not isinstance(admins, list) or not all(isinstance(name, str) for name in admins):
+        print("Error: adminUsers must be a list of usernames")
+        sys.exit(1)
+    metrics_port = config.setdefault('metricsPort', None)
+    if metrics_port is not None and (not isinstance(metrics_port, int) or not (1024 <= metrics_port <= 65535)):
+        print("Error: metricsPort number out of range")
+        sys.exit(1)
+    ttl = config.setdefault('sessionTokenTTL', 3600)
+    if not isinstance(ttl, int) or ttl < 1:
+        print("Error: sessionTokenTTL must be a positive number of seconds")
+        sys.exit(1)
+    grace = config.setdefault('resumeGracePeriod', 30)
+    if not isinstance(grace, (int, float)) or grace < 0:
+        print("Error: resumeGracePeriod must be a non-negative number of seconds")
+        sys.exit(1)
+    for key, default in (('loginTimeout', 30), ('idleTimeout', 600), ('turnTimeout', 0)):
+        limit = config.setdefault(key, default)
+        if not isinstance(limit, (int, float)) or limit < 0:
+            print(f"Error: {key} must be a non-negative number of seconds")
+            sys.exit(1)
+    bot_table = config.setdefault('botTable', None)
+    if bot_table is not None and not isinstance(bot_table, str):
+        print("Error: botTable must be a file path")
+        sys.exit(1)
+    bot_delay = config.setdefault('quickplayBotDelay', 0)
+    if not isinstance(bot_delay, (int, float)) or bot_delay < 0:
+        print("Error: quickplayBotDelay must be a non-negative number of seconds")
+        sys.exit(1)
+    if bot_delay and bot_table is None:
+        print("Error: quickplayBotDelay needs a botTable")
+        sys.exit(1)
+    game_log_path = config.setdefault('gameLog', None)
+    if game_log_path is not None and not isinstance(game_log_path, str):
+        print("Error: gameLog must be a file path")
+        sys.exit(1)
+    flush_interval = config.setdefault('gameLogFlushInterval', 0.1)
+    if not isinstance(flush_interval, (int, float)) or flush_interval <= 0:
+        print("Error: gameLogFlushInterval must be a positive number of seconds")
+        sys.exit(1)
+    pool_type = config.setdefault('hashPoolType', 'thread')
+    if pool_type not in ('thread', 'process'):
+        print("Error: hashPoolType must be 'thread' or 'process'")
+        sys.exit(1)
+    profile_dir = config.setdefault('profileDirectory', '.')
+    if not isinstance(profile_dir, str) or not os.path.isdir(os.path.expanduser(profile_dir)):
+        print("Error: profileDirectory must be an existing directory")
+        sys.exit(1)
     return config
 
-def load_users(user_file):
-    user_file = os.path.expanduser(user_file)
-    if not os.path.exists(user_file):
-        users = []
-        save_users(users, user_file)
-        return users
+def hash_password(password, rounds=12):
+    """Hash a password with a fresh salt. Runs on the hash pool."""
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds)).decode()
+
+def verify_password(password, hashed_password):
+    """Check a password against its stored hash. Runs on the hash pool."""
+    return bcrypt.checkpw(password.encode(), hashed_password.encode())
+
+def start_hash_pool(config):
+    """Create the password hashing pool and the socket pair used to wake the loop.
+
+    The engine watches hash_wakeup_reader and calls run_completed_hash_jobs.
+    """
+    global hash_pool, hash_wakeup_reader, hash_wakeup_writer
+    if config['hashPoolType'] == 'process':
+        hash_pool = ProcessPoolExecutor(max_workers=config['hashWorkers'])
+    else:
+        hash_pool = ThreadPoolExecutor(max_workers=config['hashWorkers'], thread_name_prefix="bcrypt")
+    hash_wakeup_reader, hash_wakeup_writer = socket.socketpair()
+    hash_wakeup_reader.setblocking(False)
+    hash_wakeup_writer.setblocking(False)
+
+def submit_hash_job(conn, func, args, on_done):
+    """Run func(*args) on the hash pool and call on_done(result) back on the event loop.
+
+    on_done receives None if the job raised. Commands from conn are held
+    until the job is done.
+    """
+    sessions[conn].paused = True
+    submitted = time.perf_counter()
+    future = hash_pool.submit(timed_call, func, *args)
+    future.add_done_callback(lambda f: _hash_job_finished(f, conn, on_done, submitted))
+
+def timed_call(func, *args):
+    """Return func(*args) and the seconds it took. Runs on the hash pool."""
+    started = time.perf_counter()
+    return func(*args), time.perf_counter() - started
+
+def _hash_job_finished(future, conn, on_done, submitted):
+    # Called from a pool thread: hand the result over to the loop thread.
+    completed_hash_jobs.put((future, conn, on_done, submitted))
     try:
-        with open(user_file, 'r') as file:
-            users = json.load(file)
-            if isinstance(users, list):
-                return users
-            else:
-                raise ValueError("Invalid JSON structure")
-    except json.JSONDecodeError:
-        print(f"Error: {user_file} is not in a valid JSON format.")
-        sys.exit(1)
+        hash_wakeup_writer.send(b"\0")
+    except BlockingIOError:
+        pass  # Wakeup already pending, the loop will drain every queued job
 
-def save_users(users, user_file):
-    user_file = os.path.expanduser(user_file)
+def run_completed_hash_jobs():
+    """Deliver the results of finished hash jobs. Called from the event loop."""
     try:
-        with open(user_file, 'w') as file:
-            json.dump(users, file, indent=4)
-            file.flush()
-    except Exception as e:
-        print(f"Error saving users: {e}")
+        while hash_wakeup_reader.recv(4096):
+            pass
+    except BlockingIOError:
+        pass
+    while True:
+        try:
+            future, conn, on_done, submitted = completed_hash_jobs.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            result, seconds = future.result()
+            metrics.histogram('bcrypt_seconds', "Time bcrypt took per hash or check").observe(seconds)
+        except Exception as e:
+            auth_log.error("Password hashing failed: %s", e)
+            result = None
+        metrics.histogram(
+            'hash_job_seconds', "Time from submitting a hash job to its result reaching the loop"
+        ).observe(time.perf_counter() - submitted)
+        on_done(result)
+        session = sessions.get(conn)
+        if session is not None:  # Still connected
+            session.paused = False
+            resume, session.resume = session.resume, None
+            if resume:
+                resume()
 
 def check_login(conn, username, password, users):
-    for user in users:
-        if user.get('username') == username:
-            if bcrypt.checkpw(password.encode(), user['password'].encode()):
-                authenticated_clients[conn] = True  # Mark this connection as authenticated
-                client_usernames[conn] = username  # Map connection to username
-                return "LOGIN:ACKSTATUS:0\n"  # Successful login
-            return "LOGIN:ACKSTATUS:2\n"  # Wrong password
-    return "LOGIN:ACKSTATUS:1\n"  # User not found
+    """Verify the password on the hash pool and reply with the LOGIN result."""
+    user = users.get(username)
+    if user is None:
+        send_message(conn, "LOGIN:ACKSTATUS:1\n")  # User not found
+        return
+
+    def on_verified(matches):
+        session = sessions.get(conn)
+        if session is None:
+            return  # Disconnected while hashing
+        if matches:
+            authenticate(conn, username)
+            send_message(conn, f"LOGIN:ACKSTATUS:0:{issue_token(username)}\n")  # Successful login
+        else:
+            send_message(conn, "LOGIN:ACKSTATUS:2\n")  # Wrong password
+    submit_hash_job(conn, verify_password, (password, user['password']), on_verified)
+
+
+def issue_token(username):
+    """Return a session token for username: its expiry time and an HMAC of both."""
+    expiry = int(time.time()) + token_ttl
+    return f"{expiry}.{token_signature(username, expiry)}"
+
+
+def token_signature(username, expiry):
+    return hmac.new(token_secret, f"{username}:{expiry}".encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def check_token(username, token):
+    """Check that token was issued for username and has not expired."""
+    expiry, _, signature = token.partition(".")
+    if not expiry.isdigit() or int(expiry) < time.time():
+        return False
+    return hmac.compare_digest(signature.encode(), token_signature(username, int(expiry)).encode())
+
+
+def handle_resume(conn, data, selector):
+    """Authenticate with a session token and take back a seat held since a disconnect."""
+    parts = data.strip().split(":")
+    if len(parts) != 3:
+        send_message(conn, "RESUME:ACKSTATUS:3\n")  # Invalid format
+        return
+    _, username, token = parts
+    if not check_token(username, token):
+        send_message(conn, "RESUME:ACKSTATUS:1\n")  # Bad or expired token
+        return
+    session = sessions[conn]
+    if username not in detached_players and username in remote_detached and session.room_name is None:
+        hand_off_connection(conn, selector, remote_detached[username], data)  # The seat is there
+        return
+    authenticate(conn, username)
+    room_name = None if session.room_name else reattach_player(conn, username)
+    if room_name is None:
+        send_message(conn, f"RESUME:ACKSTATUS:0:{issue_token(username)}\n")
+        return
+    room = rooms[room_name]
+    send_message(conn, f"RESUME:ACKSTATUS:0:{issue_token(username)}:{room_name}\n")
+    if room.players == 2:
+        send_message(conn, f"BEGIN:{room.player1_username}:{room.player2_username}\n")
+    send_board_snapshot(conn, room)
+    room_log.info("Player resumed", extra={'room': room_name, 'user': username})
+
+
+def detach_player(conn, session):
+    """Hold a dropped player's seat for the grace period instead of forfeiting."""
+    seats = detached_players.setdefault(session.username, [])
+    timer = timers.schedule(resume_grace, expire_seat, session.username, conn)
+    seats.append((timer, session.room_name, conn))
+    publish_detached(session.username)
+    room_log.info("Player disconnected, holding their seat", extra={'room': session.room_name, 'user': session.username})
+
+
+def reattach_player(conn, username):
+    """Seat conn where username's oldest held seat is. Returns the room name, or None."""
+    seats = detached_players.get(username)
+    if seats is None:
+        return None
+    room_name = None
+    while seats:
+        timer, held_room, old_conn = seats.pop(0)
+        timers.cancel(timer)
+        room = rooms.get(held_room)
+        if room is None:
+            continue  # The game ended without them
+        if room.player1 is old_conn:
+            room.player1 = conn
+            role = 'player1'
+        elif room.player2 is old_conn:
+            room.player2 = conn
+            role = 'player2'
+        else:
+            continue
+        if room.current_turn is old_conn:
+            room.current_turn = conn
+        if old_conn in room.move_queues:
+            room.move_queues[conn] = room.move_queues.pop(old_conn)
+        set_client_room(conn, held_room, role)
+        room_name = held_room
+        break
+    if not seats:
+        del detached_players[username]
+    publish_detached(username)
+    return room_name
+
+
+def expire_seat(username, old_conn):
+    """Forfeit the game of a player whose grace period has run out."""
+    seats = detached_players[username]
+    for index, (_, room_name, conn) in enumerate(seats):
+        if conn is old_conn:
+            del seats[index]
+            break
+    room = rooms.get(room_name)
+    if room is not None and old_conn in (room.player1, room.player2):
+        room_log.info("Held seat expired", extra={'room': room_name, 'user': username})
+        forfeit_game(room, old_conn)
+    if not seats:
+        del detached_players[username]
+    publish_detached(username)
+
+
+def authenticate(conn, username):
+    """Log the connection in as username and swap its login deadline for the idle check."""
+    session = sessions[conn]
+    session.authenticated = True
+    session.username = username
+    watch_connection(conn)
+
+
+def watch_connection(conn):
+    """Start the login deadline, or the idle check once logged in, for a connection."""
+    session = sessions[conn]
+    timers.cancel(session.timer)
+    session.timer = None
+    if not session.authenticated and login_timeout:
+        session.timer = timers.schedule(login_timeout, on_login_deadline, conn)
+    elif session.authenticated and idle_timeout:
+        session.timer = timers.schedule(idle_timeout, on_idle_check, conn)
+
+
+def on_login_deadline(conn):
+    session = sessions.get(conn)
+    if session is None or session.authenticated:
+        return
+    metrics.increment('connections_timed_out_total', "Connections closed by a deadline, by reason",
+                      labels=(('reason', 'login'),))
+    connection_log.info("Closing connection: did not log in within %s seconds", login_timeout)
+    close_connection(conn, peer_selector)
+
+
+def on_scrape_deadline(conn):
+    if conn not in sessions:
+        return
+    metrics.increment('connections_timed_out_total', "Connections closed by a deadline, by reason",
+                      labels=(('reason', 'scrape'),))
+    metrics_log.info("Closing metrics connection: scrape not done within %s seconds", SCRAPE_TIMEOUT)
+    close_connection(conn, peer_selector)
+
 
+def on_idle_check(conn):
+    """Close the connection if it has been idle for idle_timeout, or check again when it could be.
 
-def handle_register(conn, data, users, user_file):
+    Clients in a room or in the QUICKPLAY queue are never idle: viewers and
+    players waiting for an opponent have nothing to send.
+    """
+    session = sessions.get(conn)
+    if session is None:
+        return
+    if session.room_name or quickplay_queue.get(session.username) is conn:
+        session.last_active = time.monotonic()
+    # Activity only updates last_active, so the timer is rescheduled here
+    # rather than on every read
+    idle_for = time.monotonic() - session.last_active
+    if idle_for < idle_timeout:
+        session.timer = timers.schedule(idle_timeout - idle_for, on_idle_check, conn)
+        return
+    session.timer = None
+    metrics.increment('connections_timed_out_total', "Connections closed by a deadline, by reason",
+                      labels=(('reason', 'idle'),))
+    connection_log.info("Closing idle connection", extra={'user': session.username})
+    close_connection(conn, peer_selector)
+
+
+def start_turn_clock(room):
+    """Give the player whose turn it is turn_timeout seconds to move."""
+    timers.cancel(room.turn_timer)
+    room.turn_timer = timers.schedule(turn_timeout, on_turn_timeout, room) if turn_timeout else None
+
+
+def on_turn_timeout(room):
+    if rooms.get(room.name) is not room:
+        return  # The game is over
+    room.turn_timer = None
+    loser = room.player1_username if room.current_turn is room.player1 else room.player2_username
+    metrics.increment('turns_timed_out_total', "Games forfeited because a player ran out of time")
+    game_log.info("Turn timed out", extra={'room': room.name, 'user': loser})
+    # Not handle_forfeit: the player may have dropped, with their seat held
+    forfeit_game(room, room.current_turn)
+
+
+def publish_detached(username):
+    """Tell the other workers whether this one holds a seat for username."""
+    if worker_count == 1:
+        return
+    header = {'type': 'detached', 'username': username, 'worker': worker_id, 'held': username in detached_players}
+    for peer_id in peer_sockets:
+        send_to_peer(peer_id, header)
+
+
+def handle_register(conn, data, users):
     """Handle user registration."""
     parts = data.strip().split(":")
     if len(parts) != 3:
-        conn.sendall("REGISTER:ACKSTATUS:2\n".encode())  # Invalid format
+        send_message(conn, "REGISTER:ACKSTATUS:2\n")  # Invalid format
         return
 
     _, username, password = parts
-    response = register_user(username, password, users, user_file)
-    conn.sendall(response.encode())
-
-def register_user(username, password, users, user_file):
-    for user in users:
-        if user.get('username') == username:
-            return "REGISTER:ACKSTATUS:1\n"  # User already exists
-    hashed_password = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
-    new_user = {"username": username, "password": hashed_password}
-    users.append(new_user)
-    save_users(users, user_file)
-    return "REGISTER:ACKSTATUS:0\n"  # Successful registration
+    register_user(conn, username, password, users)
+
+def register_user(conn, username, password, users):
+    """Hash the new password on the hash pool, then store the user and reply."""
+    if username == BOT_USERNAME:
+        send_message(conn, "REGISTER:ACKSTATUS:1\n")  # Taken by bot opponents
+        return
+    if username in pending_registrations:
+        send_message(conn, "REGISTER:ACKSTATUS:1\n")  # Same name is being registered
+        return
+    if users.get(username) is not None:
+        send_message(conn, "REGISTER:ACKSTATUS:1\n")  # User already exists
+        return
+    pending_registrations.add(username)
+
+    def on_hashed(hashed_password):
+        pending_registrations.discard(username)
+        if hashed_password is None:
+            send_message(conn, "REGISTER:ACKSTATUS:2\n")
+            return
+        if users.add(username, hashed_password):
+            send_message(conn, "REGISTER:ACKSTATUS:0\n")  # Successful registration
+        else:
+            send_message(conn, "REGISTER:ACKSTATUS:1\n")  # Registered elsewhere meanwhile
+    submit_hash_job(conn, hash_password, (password, bcrypt_rounds), on_hashed)
 
 def handle_roomlist(conn, data):
-    """Handle ROOMLIST request and send available rooms based on mode."""
+    """Handle ROOMLIST request and send available rooms based on mode.
+
+    ROOMLIST:<mode> lists every room. ROOMLIST:<mode>:<page>[:<prefix>] lists
+    one page of ROOMLIST_PAGE_SIZE rooms in name order, optionally only those
+    whose name starts with prefix, followed by the number of rooms that matched.
+    """
     parts = data.strip().split(":")
     
-    # Validate the format - there should be exactly 2 parts (ROOMLIST and mode)
-    if len(parts) != 2:
-        conn.sendall("ROOMLIST:ACKSTATUS:1\n".encode())  # Invalid format
+    # Validate the format - ROOMLIST and mode, then optionally a page and a prefix
+    if not 2 <= len(parts) <= 4:
+        send_message(conn, "ROOMLIST:ACKSTATUS:1\n")  # Invalid format
         return
 
     mode = parts[1]
     
     # Check if mode is valid (should be PLAYER or VIEWER)
     if mode.upper() not in ["PLAYER", "VIEWER"]:
-        conn.sendall("ROOMLIST:ACKSTATUS:1\n".encode())  # Invalid mode
+        send_message(conn, "ROOMLIST:ACKSTATUS:1\n")  # Invalid mode
         return
 
-    # Filter rooms based on the valid mode
-    if mode.upper() == "PLAYER":
-        available_rooms = [name for name, room in rooms.items() if room['players'] < 2]
-    else:  # mode is VIEWER
-        available_rooms = list(rooms.keys())  # Show all rooms for VIEWER mode
-    
-    # Send room list or notify no rooms available
-    if available_rooms:
-        room_list = ",".join(available_rooms)
-        conn.sendall(f"ROOMLIST:ACKSTATUS:0:Rooms available to join as {mode}: {room_list}\n".encode())
+    # PLAYER lists rooms with a free seat, VIEWER lists all rooms
+    available_rooms = room_index[mode.upper()]
+
+    if len(parts) == 2:
+        cache = roomlist_cache[mode.upper()]
+        reply = cache.get(mode)
+        if reply is None:
+            # Send room list or notify no rooms available
+            if available_rooms:
+                room_list = ",".join(available_rooms)
+                reply = f"ROOMLIST:ACKSTATUS:0:Rooms available to join as {mode}: {room_list}\n".encode()
+            else:
+                reply = b"ROOMLIST:ACKSTATUS:0:\n"
+            cache[mode] = reply
+        queue_bytes(conn, reply)
+        return
+
+    if not parts[2].isdigit() or int(parts[2]) < 1:
+        send_message(conn, "ROOMLIST:ACKSTATUS:1\n")  # Invalid page
+        return
+    names = sorted_room_names[mode.upper()]
+    if len(parts) == 4:
+        prefix = parts[3]
+        # The matches are one range of the sorted names. Room names never contain
+        # U+10FFFF, so every name starting with prefix sorts below prefix + U+10FFFF.
+        start = bisect_left(names, prefix)
+        end = bisect_left(names, prefix + "\U0010ffff", start)
+    else:
+        start, end = 0, len(names)
+    first = start + (int(parts[2]) - 1) * ROOMLIST_PAGE_SIZE
+    page = names[first:min(end, first + ROOMLIST_PAGE_SIZE)]
+    if page:
+        room_list = ",".join(page)
+        send_message(conn, f"ROOMLIST:ACKSTATUS:0:Rooms available to join as {mode}: {room_list}:{end - start}\n")
     else:
-        conn.sendall(f"ROOMLIST:ACKSTATUS:0:\n".encode())
+        send_message(conn, f"ROOMLIST:ACKSTATUS:0:\n")
+
+
+def update_room_index(room_name, players):
+    """Record a room's player count, or None once it is deleted, for ROOMLIST."""
+    for mode, listed in (('PLAYER', players is not None and players < 2), ('VIEWER', players is not None)):
+        names = room_index[mode]
+        if listed != (room_name in names):
+            ordered = sorted_room_names[mode]
+            if listed:
+                names[room_name] = None
+                insort(ordered, room_name)
+            else:
+                del names[room_name]
+                del ordered[bisect_left(ordered, room_name)]
+            roomlist_cache[mode].clear()
 
 
 def handle_place_message(room_name, conn, x, y):
     room = get_room_or_send_noroom(room_name, conn)
     if not room:
-        conn.sendall("NOROOM\n".encode())
         return
 
-    # Ignore move if it's not the player's turn
-    if conn != room['current_turn']:
-        room['move_queue'].append((conn, x, y))  # Add to queue
-        conn.sendall("PLACE:ACKSTATUS:3\n".encode())  # Tell client their move was queued
+    # Nobody moves before the game begins: start_game gives player 1 the first turn
+    if room.player2 is None:
+        send_message(conn, "PLACE:ACKSTATUS:5\n")  # Waiting for an opponent
         return
 
-    board = room['board']
-    # Check if the position is already occupied
-    if board[y][x] != ' ':
-        conn.sendall("PLACE:ACKSTATUS:2\n".encode())  # Invalid move
+    # Check the position is on the board and not already occupied
+    if not is_free_cell(room, x, y):
+        send_message(conn, "PLACE:ACKSTATUS:2\n")  # Invalid move
         return
 
-    # Determine the marker based on the current turn
-    marker = 'X' if conn == room['player1'] else 'O'
-    # Place the marker ('X' or 'O') on the board
-    board[y][x] = marker
-
-    # Convert the 2D board to a 9-character string (1D representation)
-    board_status = ''.join(
-        ['0' if cell == ' ' else '1' if cell == 'X' else '2' for row in board for cell in row]
-    )
+    # Queue the move if it's not the player's turn
+    if conn != room.current_turn:
+        queue = room.move_queues.setdefault(conn, deque())
+        if len(queue) >= max_queued_moves:
+            send_message(conn, "PLACE:ACKSTATUS:4\n")  # Too many queued moves
+            return
+        queue.append((x, y))
+        send_message(conn, "PLACE:ACKSTATUS:3\n")  # Tell client their move was queued
+        return
 
-    # Check for a win or a draw
-    if check_winner(board, marker):
-        winner_username = get_username_from_conn(conn)
-        send_gameend_message(room, board_status, 0, winner_username)
-        delete_room(room_name)  # End game and delete room
-    elif is_draw(board):
-        send_gameend_message(room, board_status, 1)
-        delete_room(room_name)  # End game and delete room
+    # Play the move, then any moves the next player has queued, and so on.
+    # The boards they produce go out together in a single broadcast.
+    messages = []
+    deltas = []
+    rejected = {}  # Player -> number of queued moves that are no longer valid
+    stuck_bot = None
+    while True:
+        message, delta, game_over = place_mark(room, conn, x, y)
+        messages.append(message)
+        deltas.append(delta)
+        if game_over:
+            break
+        conn = room.current_turn
+        if isinstance(conn, Bot):
+            cell = bot.best_move(room.x_mask, room.o_mask)
+            if cell == bot.NO_MOVE:
+                stuck_bot = conn  # The table has no move for a board that cannot occur
+                break
+            x, y = cell % 3, cell // 3
+            continue
+        queue = room.move_queues.get(conn)
+        while queue and not is_free_cell(room, *queue[0]):
+            queue.popleft()
+            rejected[conn] = rejected.get(conn, 0) + 1
+        if not queue:
+            break
+        x, y = queue.popleft()
+
+    broadcast_to_room(room, "".join(messages), "".join(deltas))
+    if game_over:
+        delete_room(room_name)  # End game and delete room; queued moves go with it
+        return
+    if stuck_bot is not None:
+        game_log.error("Bot has no move, forfeiting for it",
+                       extra={'room': room_name, 'board': room.board_status()})
+        forfeit_game(room, stuck_bot)
+        return
+    start_turn_clock(room)
+
+    # Moves still queued for cells that have since been taken can never be played
+    for player, queue in room.move_queues.items():
+        valid = [move for move in queue if is_free_cell(room, *move)]
+        if len(valid) != len(queue):
+            rejected[player] = rejected.get(player, 0) + len(queue) - len(valid)
+            queue.clear()
+            queue.extend(valid)
+    for player, count in rejected.items():
+        send_message(player, "PLACE:ACKSTATUS:2\n" * count)
+
+
+def is_free_cell(room, x, y):
+    """Check that (x, y) is on the board and not yet taken."""
+    return 0 <= x < 3 and 0 <= y < 3 and not (room.x_mask | room.o_mask) & bitboard.cell_bit(x, y)
+
+
+def place_mark(room, conn, x, y):
+    """Play a valid move for the player whose turn it is.
+
+    Returns the message announcing the new board, the same for clients that
+    take deltas, and whether the game is over.
+    """
+    # Player 1 places X, player 2 places O
+    cell = y * 3 + x
+    if conn == room.player1:
+        room.x_mask |= bitboard.cell_bit(x, y)
+        won = bitboard.wins(room.x_mask)
+        mark = 1
     else:
-        # Switch turns between player1 and player2
-        room['current_turn'] = room['player2'] if conn == room['player1'] else room['player1']
-        
-        # Send the BOARDSTATUS message to all players and viewers
-        board_status_message = f"BOARDSTATUS:{board_status}\n"
-        broadcast_to_room(room, board_status_message)
+        room.o_mask |= bitboard.cell_bit(x, y)
+        won = bitboard.wins(room.o_mask)
+        mark = 2
+    gamelog.record('PLACE', room.game_id, mark, cell)
 
-        # Process any queued moves for the next player
-        process_queued_moves(room_name)
+    # 9-character board string (1D representation)
+    board_status = room.board_status()
 
-def process_queued_moves(room_name):
-    room = rooms[room_name]
-    if not room['move_queue']:
-        return
+    # Check for a win or a draw
+    if won:
+        # By seat rather than connection: a queued move may be played for a player who has dropped
+        winner_username = room.player1_username if mark == 1 else room.player2_username
+        gamelog.record('GAMEEND', room.game_id, 0, winner_username, room.x_mask, room.o_mask)
+        message = gameend_message(board_status, 0, winner_username)
+        return message, message, True  # GAMEEND carries the full board for everyone
+    if bitboard.is_full(room.x_mask, room.o_mask):
+        gamelog.record('GAMEEND', room.game_id, 1, '', room.x_mask, room.o_mask)
+        message = gameend_message(board_status, 1)
+        return message, message, True
+
+    # Switch turns between player1 and player2
+    room.current_turn = room.player2 if conn == room.player1 else room.player1
+    return f"BOARDSTATUS:{board_status}\n", f"BOARDDELTA:{room.sequence()}:{cell}:{mark}\n", False
 
-    # Check if the queued move is for the player whose turn it is
-    next_conn, x, y = room['move_queue'][0]
-    if next_conn == room['current_turn']:
-        room['move_queue'].pop(0)  # Remove from the queue
-        handle_place_message(room_name, next_conn, x, y)  # Process the queued move
-        # Recursively check for the next queued move
-        process_queued_moves(room_name)
 
-    
 def get_room_or_send_noroom(room_name, conn):
     """Helper function to get the room for a client or send NOROOM if not found."""
-    for room_name, room in rooms.items():
-        if conn == room['player1'] or conn == room['player2']:
-            return room
+    if get_room_for_player(conn) == room_name:
+        return rooms[room_name]
     # If no room is found, send the NOROOM message
-    conn.sendall("NOROOM\n".encode())
+    send_message(conn, "NOROOM\n")
     return None
 
-def send_gameend_message(room, board_status, status_code, winner_username=None):
-    """Send GAMEEND message to all players and viewers in the room."""
+def gameend_message(board_status, status_code, winner_username=None):
+    """Build the GAMEEND message for a finished game."""
     if status_code == 0:  # Game won by a player
-        gameend_message = f"GAMEEND:{board_status}:0:{winner_username}\n"
+        return f"GAMEEND:{board_status}:0:{winner_username}\n"
     elif status_code == 1:  # Game ended in a draw
-        gameend_message = f"GAMEEND:{board_status}:1\n"
+        return f"GAMEEND:{board_status}:1\n"
     elif status_code == 2:  # Game ended by forfeit
-        gameend_message = f"GAMEEND:{board_status}:2:{winner_username}\n"
-    
-    # Send GAMEEND to all players and viewers
-    broadcast_to_room(room, gameend_message)
-
-def broadcast_to_room(room, message):
-    """Broadcast a message to all players and viewers in the room."""
-    for player in [room['player1'], room['player2']]:
-        print("in here ie error is with accessing player")
-        player.sendall(message.encode())
-    
-    for viewer in room['viewers']:
-        print("in here ie error is with accessing viewer")
-        viewer.sendall(message.encode())
+        return f"GAMEEND:{board_status}:2:{winner_username}\n"
+
+def send_gameend_message(room, board_status, status_code, winner_username=None):
+    """Send GAMEEND message to all players and viewers in the room."""
+    broadcast_to_room(room, gameend_message(board_status, status_code, winner_username))
+
+def broadcast_to_room(room, message, delta_message=None):
+    """Broadcast a message to all players and viewers in the room.
+
+    Clients that asked for deltas get delta_message instead, when there is one.
+    """
+    data = message.encode()  # Encoded once and shared by every recipient
+    delta_data = data if delta_message is None else delta_message.encode()
+    game_log.debug("Broadcasting %r to %d viewer(s) and the players", message, len(room.viewers),
+                   extra={'room': room.name})
+    for member in (room.player1, room.player2, *room.viewers):
+        if member is not None:  # player2 is None until someone joins
+            session = sessions.get(member)
+            queue_bytes(member, delta_data if session is not None and session.deltas else data)
 
 def delete_room(room_name):
     """Delete the room once the game ends."""
-    if room_name in rooms:
-        del rooms[room_name]
-    print(f"Room '{room_name}' has been deleted.")
+    room = rooms.pop(room_name, None)
+    if room:
+        timers.cancel(room.turn_timer)
+        for member in [room.player1, room.player2] + room.viewers:
+            session = sessions.get(member)
+            # A client may have moved on to another room since
+            if session is not None and session.room_name == room_name:
+                session.room_name = session.role = None
+                session.last_active = time.monotonic()  # Idle from the end of the game
+        publish_room(room_name)
+    room_log.info("Room deleted", extra={'room': room_name})
 
 def handle_forfeit(conn, room_name):
     room = get_room_or_send_noroom(room_name, conn)
     if not room:
-        conn.sendall("NOROOM\n".encode())
         return
+    forfeit_game(room, conn)
+
 
-    forfeiting_player = conn
-    opponent = room['player1'] if conn == room['player2'] else room['player2']
-    winner_username = get_username_from_conn(opponent)
+def forfeit_game(room, conn):
+    """End the game in room with a win for the opponent of the player on conn."""
+    winner_username = room.player1_username if conn == room.player2 else room.player2_username
 
     # Convert the board to string format for the GAMEEND message
-    board_status = ''.join(['0' if cell == ' ' else '1' if cell == 'X' else '2' for row in room['board'] for cell in row])
+    board_status = room.board_status()
 
     # Send GAMEEND message with the forfeit code (2)
     send_gameend_message(room, board_status, 2, winner_username)
-    
-    # Remove room after forfeit
-    delete_room(room_name)
-
-
-def check_winner(board: List[List[str]], player: str) -> bool:
-    """Check if the given player has won the game."""
-
-    # Check rows
-    for row in board:
-        if all(cell == player for cell in row):
-            return True
-
-    # Check columns
-    for col in range(3):
-        if all(board[row][col] == player for row in range(3)):
-            return True
-
-    # Check diagonals
-    if all(board[i][i] == player for i in range(3)):
-        return True
-    if all(board[i][2 - i] == player for i in range(3)):
-        return True
-
-    return False
-
-def is_draw(board: List[List[str]]) -> bool:
-    """Check if the game is a draw."""
-    # If any cell is still empty, the game is not a draw
-    for row in board:
-        if ' ' in row:
-            return False
-    return True  # No empty spaces, so it's a draw
+    gamelog.record('GAMEEND', room.game_id, 2, winner_username or '', room.x_mask, room.o_mask)
 
+    # Remove room after forfeit
+    delete_room(room.name)
 
 
 def handle_create(conn, data):
     """Handle room creation request."""
     parts = data.strip().split(":")
     if len(parts) != 2:
-        conn.sendall("CREATE:ACKSTATUS:4\n".encode())  # Invalid format
+        send_message(conn, "CREATE:ACKSTATUS:4\n")  # Invalid format
         return
 
     _, room_name = parts
+
+    if get_room_for_player(conn):
+        send_message(conn, "CREATE:ACKSTATUS:5\n")  # Already seated in another room
+        return
     
     # Validate the room name
     if not re.match(r'^[\w\s-]+$', room_name) or len(room_name) > 20:
-        conn.sendall("CREATE:ACKSTATUS:1\n".encode())  # Invalid room name
+        send_message(conn, "CREATE:ACKSTATUS:1\n")  # Invalid room name
         return
     
-    if len(rooms) >= 256:
-        conn.sendall("CREATE:ACKSTATUS:3\n".encode())  # Max rooms limit reached
+    if len(rooms) + len(remote_rooms) >= max_rooms:
+        send_message(conn, "CREATE:ACKSTATUS:3\n")  # Max rooms limit reached
         return
     
-    if room_name in rooms:
-        conn.sendall("CREATE:ACKSTATUS:2\n".encode())  # Room already exists
+    if room_name in rooms or room_name in remote_rooms:
+        send_message(conn, "CREATE:ACKSTATUS:2\n")  # Room already exists
         return
 
-    # Initialize the board with empty spaces (' ')
-    initial_board = [[' ' for _ in range(3)] for _ in range(3)]  # A 3x3 grid filled with empty spaces
-
     # Create the room and automatically join the user
-    rooms[room_name] = {
-        'modes': ["PLAYER", "VIEWER"],
-        'players': 1,
-        'viewers': [],
-        'player1': conn,
-        'player1_username': get_username_from_conn(conn),
-        'player2': None,  # Will be assigned later
-        'player2_username': None,  # Will be assigned later
-        'board': initial_board,  # Set the empty 3x3 board
-        'current_turn': conn,  # Track whose turn it is (starts with player1)
-        'move_queue': []  # Queue for moves that are sent out of turn
-    }
+    create_room(conn, room_name)
+    send_message(conn, "CREATE:ACKSTATUS:0\n")  # Room successfully created
 
-    conn.sendall("CREATE:ACKSTATUS:0\n".encode())  # Room successfully created
-    print(f"Successfully created room {room_name}")
+
+def create_room(conn, room_name):
+    """Create a room with the client on conn as player 1, and return it."""
+    room = rooms[room_name] = Room(room_name, conn, get_username_from_conn(conn))
+    set_client_room(conn, room_name, 'player1')
+    gamelog.record('CREATE', room.game_id, room_name, room.player1_username)
+    publish_room(room_name)
+    room_log.info("Room created", extra={'room': room_name, 'user': room.player1_username})
+    return room
+
+
+def seat_player2(conn, room, username):
+    """Seat the client on conn as player 2. The caller starts the game."""
+    room.player2 = conn
+    room.player2_username = username
+    set_client_room(conn, room.name, 'player2')
+    gamelog.record('JOIN', room.game_id, username, 1)
+    room_log.debug("Room %s now has %d player(s)", room.name, room.players)
+    publish_room(room.name)
 
 
 def handle_join(conn, room_name, mode, username):
     """Handle room join request."""
+    if get_room_for_player(conn):
+        send_message(conn, "JOIN:ACKSTATUS:4\n")  # Already seated in another room
+        return
     if room_name not in rooms:
-        conn.sendall(f"JOIN:ACKSTATUS:1\n".encode())  # Room doesn't exist
+        send_message(conn, f"JOIN:ACKSTATUS:1\n")  # Room doesn't exist
         return
     if mode.upper() not in ["PLAYER", "VIEWER"]:
-        conn.sendall("JOIN:ACKSTATUS:3\n".encode())  # Invalid mode
+        send_message(conn, "JOIN:ACKSTATUS:3\n")  # Invalid mode
         return
     
     room = rooms[room_name]
     
-    if mode.upper() == "PLAYER" and room['players'] >= 2:
-        conn.sendall(f"JOIN:ACKSTATUS:2\n".encode())  # Room already full
+    if mode.upper() == "PLAYER" and room.players >= 2:
+        send_message(conn, f"JOIN:ACKSTATUS:2\n")  # Room already full
         return
 
     # Join the room as a player or viewer
     if mode.upper() == "PLAYER":
-        room['players'] += 1
-        # Assign player 1 or player 2
-        if 'player1' not in room:
-            room['player1'] = conn
-            room['player1_username'] = username
-        else:
-            room['player2'] = conn
-            room['player2_username'] = username
-        print(room['players'])
+        # The creator is player 1, so a joining player takes the player 2 seat
+        seat_player2(conn, room, username)
         # Send ACK for successful join
-        conn.sendall(f"JOIN:ACKSTATUS:0\n".encode())
+        send_message(conn, f"JOIN:ACKSTATUS:0\n")
 
         # If two players have joined, start the game
-        if room['players'] == 2:
-            print("startgame called")
+        if room.players == 2:
+            game_log.debug("Starting game in room %s", room_name)
             start_game(room_name)
     
     elif mode.upper() == "VIEWER":
-        room['viewers'].append(conn)
-        conn.sendall(f"JOIN:ACKSTATUS:0\n".encode())  # ACK viewer join
+        set_client_room(conn, room_name, 'viewer')
+        room.viewers.append(conn)
+        gamelog.record('JOIN', room.game_id, username, 0)
+        send_message(conn, f"JOIN:ACKSTATUS:0\n")  # ACK viewer join
 
         # Immediately send INPROGRESS to the new viewer
-        player1_username = room['player1_username']
-        player2_username = room.get('player2_username', 'Waiting for player 2')
+        player1_username = room.player1_username
+        player2_username = room.player2_username
         inprogress_message = f"INPROGRESS:{player1_username}:{player2_username}\n"
-        conn.sendall(inprogress_message.encode())
+        send_message(conn, inprogress_message)
+
+        # Then the board so far, which later deltas build on
+        if sessions[conn].deltas:
+            send_board_snapshot(conn, room)
+        elif room.sequence():
+            send_message(conn, f"BOARDSTATUS:{room.board_status()}\n")
+
+
+def handle_quickplay(conn, data, selector):
+    """Queue the client for a game with the next player to ask, or cancel that.
+
+    QUICKPLAY replies with ACKSTATUS 0 once queued, followed by BEGIN when
+    paired; QUICKPLAY:CANCEL leaves the queue.
+    """
+    global quickplay_bot_timer
+    parts = data.strip().split(":")
+    cancel = len(parts) == 2 and parts[1].upper() == "CANCEL"
+    if len(parts) != 1 and not cancel:
+        send_message(conn, "QUICKPLAY:ACKSTATUS:5\n")  # Invalid format
+        return
+    session = sessions[conn]
+    if cancel:
+        if leave_quickplay(conn, session):
+            send_message(conn, "QUICKPLAY:ACKSTATUS:0\n")
+        else:
+            send_message(conn, "QUICKPLAY:ACKSTATUS:4\n")  # Not queued
+        return
+    if session.room_name:
+        send_message(conn, "QUICKPLAY:ACKSTATUS:1\n")  # Already in a room
+        return
+    if worker_count > 1 and worker_id != MATCHMAKER:
+        hand_off_connection(conn, selector, MATCHMAKER, data)  # Every player queues in one place
+        return
+    if session.username in quickplay_queue:
+        send_message(conn, "QUICKPLAY:ACKSTATUS:2\n")  # Already queued, here or on another connection
+        return
+    if not quickplay_queue:
+        quickplay_queue[session.username] = conn
+        if quickplay_bot_delay:
+            quickplay_bot_timer = timers.schedule(quickplay_bot_delay, on_quickplay_wait, conn)
+        send_message(conn, "QUICKPLAY:ACKSTATUS:0\n")  # Waiting for an opponent
+        return
+    if len(rooms) + len(remote_rooms) >= max_rooms:
+        send_message(conn, "QUICKPLAY:ACKSTATUS:3\n")  # Max rooms limit reached
+        return
+    opponent = next(iter(quickplay_queue.values()))
+    leave_quickplay(opponent, sessions[opponent])
+    send_message(conn, "QUICKPLAY:ACKSTATUS:0\n")
+    # The player who waited is player 1 and moves first
+    room = create_room(opponent, quickplay_room_name())
+    seat_player2(conn, room, session.username)
+    room_log.info("Paired by QUICKPLAY", extra={'room': room.name, 'user': session.username})
+    start_game(room.name)
+
+
+def leave_quickplay(conn, session):
+    """Take the client out of the QUICKPLAY queue. Returns False if it was not queued."""
+    global quickplay_bot_timer
+    if quickplay_queue.get(session.username) is not conn:
+        return False
+    del quickplay_queue[session.username]
+    timers.cancel(quickplay_bot_timer)  # Only one player waits at a time, so it was theirs
+    quickplay_bot_timer = None
+    return True
+
+
+def on_quickplay_wait(conn):
+    """Give a player who has waited quickplay_bot_delay seconds a bot to play."""
+    global quickplay_bot_timer
+    quickplay_bot_timer = None
+    session = sessions.get(conn)
+    if session is None or len(rooms) + len(remote_rooms) >= max_rooms:
+        return  # Gone, or no room to play in; a player may still arrive
+    leave_quickplay(conn, session)
+    room = create_room(conn, quickplay_room_name())
+    seat_bot(room)
+
+
+def handle_bot(conn):
+    """Seat a bot as player 2 in the room the client is waiting in, and start the game."""
+    room_name = get_room_for_player(conn)
+    if not bots_enabled:
+        send_message(conn, "BOT:ACKSTATUS:3\n")  # No bot table
+    elif room_name is None:
+        send_message(conn, "BOT:ACKSTATUS:1\n")  # Not in a room
+    elif rooms[room_name].players == 2:
+        send_message(conn, "BOT:ACKSTATUS:2\n")  # Room already full
+    else:
+        send_message(conn, "BOT:ACKSTATUS:0\n")
+        seat_bot(rooms[room_name])
+
+
+def seat_bot(room):
+    """Seat a bot as player 2 and begin the game. Its human opponent moves first."""
+    seat_player2(Bot(), room, BOT_USERNAME)
+    metrics.increment('bot_games_total', "Games started against a bot")
+    room_log.info("Bot seated", extra={'room': room.name, 'user': room.player1_username})
+    start_game(room.name)
+
+
+def quickplay_room_name():
+    """Return a free room name that this worker owns, for a QUICKPLAY game."""
+    while True:
+        room_name = f"quick-{next(quickplay_numbers)}"
+        if room_owner(room_name) == worker_id and room_name not in rooms and room_name not in remote_rooms:
+            return room_name
+
+
+def send_board_snapshot(conn, room):
+    """Send the whole board, numbered like the BOARDDELTA of its last move."""
+    send_message(conn, f"BOARDSNAPSHOT:{room.sequence()}:{room.board_status()}\n")
 
 
 def get_room_for_player(conn):
     """Find the room the player is in."""
-    for room_name, room in rooms.items():
-        if conn == room.get('player1') or conn == room.get('player2'):
-            return room_name
-    return None
+    session = sessions.get(conn)
+    if session is None or session.role == 'viewer':
+        return None
+    return session.room_name
+
+def set_client_room(conn, room_name, role):
+    """Record the room a client is in and its role there.
+
+    A viewer who moves on stops watching the room they were in. Players
+    cannot move on: handle_create and handle_join refuse them.
+    """
+    session = sessions.get(conn)
+    if session is not None:
+        if session.role == 'viewer':
+            rooms[session.room_name].viewers.remove(conn)
+        session.room_name = room_name
+        session.role = role
+        leave_quickplay(conn, session)  # Found a game some other way, if queued
 
 def start_game(room_name):
     room = rooms[room_name]
-    if 'player1' in room and 'player2' in room:
-        player1_conn = room['player1']
-        player2_conn = room['player2']
-        player1_username = room['player1_username']
-        player2_username = room['player2_username']
-        
-        room['current_turn'] = player1_conn
-        begin_message = f"BEGIN:{player1_username}:{player2_username}\n"
-        
-        all_clients = [player1_conn, player2_conn] + room.get('viewers', [])
-        
+    if room.player2 is not None:
+        player1_conn = room.player1
+        player2_conn = room.player2
+        player1_username = room.player1_username
+        player2_username = room.player2_username
+
+        room.current_turn = player1_conn
+        begin_message = f"BEGIN:{player1_username}:{player2_username}\n".encode()
+
         # Send BEGIN to players
-        for client in [player1_conn, player2_conn]:
-            client.sendall(begin_message.encode())
-        
+        for client in (player1_conn, player2_conn):
+            queue_bytes(client, begin_message)
+
         # Send INPROGRESS to viewers
-        inprogress_message = f"INPROGRESS:{player1_username}:{player2_username}\n"
-        for viewer in room['viewers']:
-            viewer.sendall(inprogress_message.encode())
+        inprogress_message = f"INPROGRESS:{player1_username}:{player2_username}\n".encode()
+        for viewer in room.viewers:
+            queue_bytes(viewer, inprogress_message)
+        start_turn_clock(room)
 
 
 def check_authenticated(conn):
     """Check if the client is authenticated."""
-    return authenticated_clients.get(conn, False)
+    session = sessions.get(conn)
+    return session is not None and session.authenticated
+
+def handle_client(conn, mask, selector, users):
+    if mask & selectors.EVENT_WRITE:
+        flush_outbound(conn, selector)
+    if mask & selectors.EVENT_READ and conn.fileno() != -1:
+        read_client(conn, selector, users)
+
+
+def read_client(conn, selector, users):
+    try:
+        data = conn.recv(8192)
+    except OSError as e:
+        connection_log.warning("Read failed: %s", e)
+        close_connection(conn, selector)
+        return
+    receive_data(conn, data, selector, users)
+
+
+def receive_data(conn, data, selector, users):
+    """Buffer data read from a client and run the commands it completes.
 
-def handle_client(conn, mask, selector, users, user_file):
+    Empty data means the client disconnected.
+    """
     try:
-        data = conn.recv(8192).decode()
         if data:
-            # Handle LOGIN command
-            if data.startswith("LOGIN"):
-                parts = data.strip().split(":")
-                if len(parts) != 3:
-                    conn.sendall("LOGIN:ACKSTATUS:3\n".encode())  # Invalid format
-                else:
-                    _, username, password = parts
-                    response = check_login(conn, username, password, users)  # Pass conn as an argument
-                    if "LOGIN:ACKSTATUS:0\n" in response:
-                        authenticated_clients[conn] = True  # Mark the client as authenticated
-                    conn.sendall(response.encode())
-
-            # Handle REGISTER command
-            elif data.startswith("REGISTER"):
-                handle_register(conn, data, users, user_file)
-
-            # Handle CREATE command
-            elif data.startswith("CREATE"):
-                if not check_authenticated(conn):
-                    conn.sendall("BADAUTH\n".encode())
-                else:
-                    handle_create(conn, data)
+            metrics.increment('bytes_received_total', "Bytes read from clients", len(data))
+            session = sessions[conn]
+            session.last_active = time.monotonic()
+            buffer = session.inbound
+            buffer += data
+            if len(buffer) > MAX_BUFFERED_INPUT:
+                connection_log.warning("Closing connection: too much unprocessed input")
+                close_connection(conn, selector)
+                return
+            process_commands(conn, selector, users)
+        else:
+            connection_log.info("Connection closed by client", extra={'user': get_username_from_conn(conn)})
+            close_connection(conn, selector)
 
-            # Handle ROOMLIST command
-            elif data.startswith("ROOMLIST"):
-                if not check_authenticated(conn):
-                    conn.sendall("BADAUTH\n".encode())
-                else:
-                    handle_roomlist(conn, data)
+    except Exception as e:
+        connection_log.error("Closing connection after error: %s", e, exc_info=True)
+        close_connection(conn, selector)
 
-            # Handle PLACE command
-            elif data.startswith("PLACE"):
-                if not check_authenticated(conn):
-                    conn.sendall("BADAUTH\n".encode())
-                else:
-                    parts = data.strip().split(":")
-                    if len(parts) == 3:
-                        _, x, y = parts
-                        room_name = get_room_for_player(conn)
-                        if room_name:
-                            # Handle the move
-                            try:
-                                x = int(x)
-                                y = int(y)
-                                handle_place_message(room_name, conn, x, y)
-                            except ValueError:
-                                pass  # Invalid coordinates
-                        else:
-                            conn.sendall("NOROOM\n".encode())  # Client is not in any room
-                    else:
-                        pass  # Invalid format
-
-
-
-
-            # Handle FORFEIT command
-            elif data.startswith("FORFEIT"):
-                if not check_authenticated(conn):
-                    conn.sendall("BADAUTH\n".encode())
+
+def process_commands(conn, selector, users):
+    """Run every complete command buffered for a client, in order.
+
+    Commands are newline-delimited; a trailing partial command is kept for
+    the next read. Processing stops while a LOGIN or REGISTER is hashing and
+    picks up again when it completes, so replies keep the order of requests.
+    """
+    session = sessions.get(conn)
+    if session is None:
+        return
+    buffer = session.inbound
+    try:
+        # The buffer always holds exactly the unprocessed input, so a handler
+        # can pass it on (see hand_off_connection). Deleting from the front
+        # of a bytearray is cheap.
+        while conn.fileno() != -1:
+            if session.paused:
+                session.resume = lambda: process_commands(conn, selector, users)
+                break
+            try:
+                if session.binary:
+                    body, size = codec.split_frame(buffer)
+                    if body is None:
+                        break
+                    line = codec.to_text(codec.decode(body))
+                    del buffer[:size]
                 else:
-                    room_name = get_room_for_player(conn)
-                    if room_name:
-                        handle_forfeit(conn, room_name)
-                    else:
-                        conn.sendall("NOROOM\n".encode())  # Client is not in any room
-
-            # Handle JOIN command
-            elif data.startswith("JOIN"):
-                if not check_authenticated(conn):
-                    conn.sendall("BADAUTH\n".encode())
+                    end = buffer.find(b"\n")
+                    if end == -1:
+                        break
+                    line = buffer[:end].decode().rstrip("\r")
+                    del buffer[:end + 1]
+            except ValueError as e:  # A malformed frame, or a line that is not UTF-8
+                connection_log.warning("Closing connection: %s", e)
+                close_connection(conn, selector)
+                return
+            if line:
+                started = time.perf_counter()
+                handle_command(conn, line, selector, users)
+                record_command(line, time.perf_counter() - started)
+    except Exception as e:
+        connection_log.error("Closing connection after error: %s", e, exc_info=True)
+        close_connection(conn, selector)
+        return
+    if session.binary and len(buffer) >= codec.FRAME_HEADER.size:
+        # A frame's length is known up front, so a long one is refused before it arrives
+        too_long = codec.FRAME_HEADER.unpack_from(buffer)[0] > MAX_COMMAND_LENGTH
+    else:
+        too_long = len(buffer) > MAX_COMMAND_LENGTH
+    if too_long and not session.paused:
+        connection_log.warning("Closing connection: command too long")
+        close_connection(conn, selector)
+
+
+command_histograms = {}  # Command name -> latency histogram
+
+
+def record_command(line, seconds):
+    """Count a handled command and record how long its handler took."""
+    name = line.partition(":")[0]
+    histogram = command_histograms.get(name)
+    if histogram is None:
+        if name not in COMMANDS:
+            name = 'OTHER'  # Keeps the set of label values bounded
+        histogram = command_histograms[name] = metrics.histogram(
+            'command_seconds', "Time to handle each command, by command", (('command', name),))
+    histogram.observe(seconds)
+
+
+def handle_command(conn, line, selector, users):
+    """Dispatch a single command line from a client."""
+    # Handle LOGIN command
+    if line.startswith("LOGIN"):
+        parts = line.strip().split(":")
+        if len(parts) != 3:
+            send_message(conn, "LOGIN:ACKSTATUS:3\n")  # Invalid format
+        else:
+            _, username, password = parts
+            check_login(conn, username, password, users)  # Replies once the hash pool is done
+
+    # Handle RESUME command
+    elif line.startswith("RESUME"):
+        handle_resume(conn, line, selector)
+
+    # Handle PROTO command
+    elif line.startswith("PROTO"):
+        handle_proto(conn, line)
+
+    # Handle REGISTER command
+    elif line.startswith("REGISTER"):
+        handle_register(conn, line, users)
+
+    # Handle CREATE command
+    elif line.startswith("CREATE"):
+        if not check_authenticated(conn):
+            send_message(conn, "BADAUTH\n")
+        else:
+            parts = line.strip().split(":")
+            if len(parts) == 2 and route_to_room_owner(conn, parts[1], line, selector):
+                return  # The owning worker will answer
+            handle_create(conn, line)
+
+    # Handle ROOMLIST command
+    elif line.startswith("ROOMLIST"):
+        if not check_authenticated(conn):
+            send_message(conn, "BADAUTH\n")
+        else:
+            handle_roomlist(conn, line)
+
+    # Handle PLACE command
+    elif line.startswith("PLACE"):
+        if not check_authenticated(conn):
+            send_message(conn, "BADAUTH\n")
+        else:
+            parts = line.strip().split(":")
+            if len(parts) == 3:
+                _, x, y = parts
+                room_name = get_room_for_player(conn)
+                if room_name:
+                    # Handle the move
+                    try:
+                        x = int(x)
+                        y = int(y)
+                        handle_place_message(room_name, conn, x, y)
+                    except ValueError:
+                        pass  # Invalid coordinates
                 else:
-                    parts = data.strip().split(":")
-                    if len(parts) != 3:
-                        conn.sendall("JOIN:ACKSTATUS:3\n".encode())  # Invalid format
-                    else:
-                        _, room_name, mode = parts
-                        username = get_username_from_conn(conn)  # Implement this function to get the username
-                        handle_join(conn, room_name, mode, username)
+                    send_message(conn, "NOROOM\n")  # Client is not in any room
+            else:
+                pass  # Invalid format
 
+    # Handle FORFEIT command
+    elif line.startswith("FORFEIT"):
+        if not check_authenticated(conn):
+            send_message(conn, "BADAUTH\n")
         else:
-            # Client disconnected, handle forfeit
             room_name = get_room_for_player(conn)
             if room_name:
                 handle_forfeit(conn, room_name)
-            print("Closing connection")
-            selector.unregister(conn)
-            conn.close()
+            else:
+                send_message(conn, "NOROOM\n")  # Client is not in any room
 
-    except Exception as e:
-        print(f"Error: {e}")
+    # Handle JOIN command
+    elif line.startswith("JOIN"):
+        if not check_authenticated(conn):
+            send_message(conn, "BADAUTH\n")
+        else:
+            parts = line.strip().split(":")
+            if len(parts) != 3:
+                send_message(conn, "JOIN:ACKSTATUS:3\n")  # Invalid format
+            else:
+                _, room_name, mode = parts
+                if route_to_room_owner(conn, room_name, line, selector):
+                    return  # The owning worker will answer
+                username = get_username_from_conn(conn)  # Implement this function to get the username
+                handle_join(conn, room_name, mode, username)
+
+    # Handle QUICKPLAY command
+    elif line.startswith("QUICKPLAY"):
+        if not check_authenticated(conn):
+            send_message(conn, "BADAUTH\n")
+        else:
+            handle_quickplay(conn, line, selector)
+
+    # Handle BOT command
+    elif line.startswith("BOT"):
+        if not check_authenticated(conn):
+            send_message(conn, "BADAUTH\n")
+        else:
+            handle_bot(conn)
+
+    # Handle BOARDSYNC command
+    elif line.startswith("BOARDSYNC"):
+        if not check_authenticated(conn):
+            send_message(conn, "BADAUTH\n")
+        else:
+            room_name = sessions[conn].room_name
+            if room_name in rooms:
+                send_board_snapshot(conn, rooms[room_name])
+            else:
+                send_message(conn, "NOROOM\n")  # Client is not in any room
+
+    # Handle STATS command
+    elif line.startswith("STATS"):
+        if not check_authenticated(conn):
+            send_message(conn, "BADAUTH\n")
+        elif get_username_from_conn(conn) not in admin_users:
+            send_message(conn, "STATS:ACKSTATUS:1\n")  # Not an admin
+        else:
+            stats = json.dumps(metrics.snapshot(collect_gauges()), separators=(",", ":"))
+            send_message(conn, f"STATS:ACKSTATUS:0:{stats}\n")
+
+    # Handle PROFILE command
+    elif line.startswith("PROFILE"):
+        if not check_authenticated(conn):
+            send_message(conn, "BADAUTH\n")
+        elif get_username_from_conn(conn) not in admin_users:
+            send_message(conn, "PROFILE:ACKSTATUS:1\n")  # Not an admin
+        else:
+            handle_profile(conn, line)
+
+
+def handle_profile(conn, data):
+    """Start or stop CPU profiling or allocation tracing in this process.
+
+    PROFILE:CPU:START|STOP and PROFILE:MEMORY:START|SNAPSHOT|STOP. Commands
+    that write a report reply with its path.
+    """
+    parts = data.strip().split(":")
+    action = tuple(parts[1:])
+    result = None
+    if action == ('CPU', 'START'):
+        result = profiling.start_cpu()
+    elif action == ('CPU', 'STOP'):
+        result = profiling.stop_cpu(profile_directory)
+    elif action == ('MEMORY', 'START'):
+        result = profiling.start_memory()
+    elif action == ('MEMORY', 'SNAPSHOT'):
+        result = profiling.snapshot_memory(profile_directory)
+    elif action == ('MEMORY', 'STOP'):
+        result = profiling.stop_memory()
+    if not result:
+        send_message(conn, "PROFILE:ACKSTATUS:2\n")  # Invalid command, or already started or stopped
+    elif result is True:
+        send_message(conn, "PROFILE:ACKSTATUS:0\n")
+    else:
+        profile_log.info("Profile written", extra={'path': result, 'user': get_username_from_conn(conn)})
+        send_message(conn, f"PROFILE:ACKSTATUS:0:{result}\n")
+
+
+def on_profile_signal(signum):
+    """SIGUSR1 starts or stops CPU profiling, SIGUSR2 starts allocation tracing or takes a snapshot.
+
+    Runs on the event loop, never in the signal handler: it logs and writes
+    files, and a handler that interrupted the loop mid-log could deadlock it.
+    """
+    if signum == signal.SIGUSR1:
+        profile_log.info(profiling.toggle_cpu(profile_directory))
+    else:
+        profile_log.info(profiling.start_or_snapshot_memory(profile_directory))
+
+
+def close_connection(conn, selector):
+    """Forfeit the client's game if it is in one and release its connection."""
+    # Check the session rather than the socket: an asyncio transport already
+    # reports itself closed when the peer resets the connection
+    session = sessions.get(conn)
+    if session is None:
+        return
+    if selector is not None:  # None under the asyncio engine
         selector.unregister(conn)
-        conn.close()
+    conn.close()
+    timers.cancel(session.timer)
+    leave_quickplay(conn, session)
+    if session.role == 'viewer':
+        rooms[session.room_name].viewers.remove(conn)
+    elif session.room_name and resume_grace:
+        detach_player(conn, session)  # Forfeited if they do not RESUME in time
+    elif session.room_name:
+        handle_forfeit(conn, session.room_name)
+    # Drop the session last, along with anything the forfeit queued for it
+    del sessions[conn]
+    pending_writes.discard(conn)
+
+
+def handle_proto(conn, data):
+    """Switch the connection between the text and binary protocols, or between
+    full boards and deltas.
+
+    The reply is sent in the protocol in use before the switch.
+    """
+    parts = data.strip().split(":")
+    if len(parts) != 2 or parts[1].upper() not in ("TEXT", "BINARY", "FULL", "DELTA"):
+        send_message(conn, "PROTO:ACKSTATUS:1\n")  # Unknown protocol
+        return
+    send_message(conn, "PROTO:ACKSTATUS:0\n")
+    option = parts[1].upper()
+    if option in ("FULL", "DELTA"):
+        sessions[conn].deltas = option == "DELTA"
+    else:
+        sessions[conn].binary = option == "BINARY"
+
+
+@lru_cache(maxsize=1024)
+def binary_frames(data):
+    """Return text protocol output re-encoded as binary frames.
+
+    Cached, so a broadcast is converted once however many binary clients get it.
+    """
+    return codec.encode_lines(data)
+
+
+def send_message(conn, message):
+    """Queue a message for a client. It is written out when the socket is ready."""
+    queue_bytes(conn, message.encode())
+
+
+def queue_bytes(conn, data):
+    """Queue already-encoded text protocol output for a client (framed for binary clients)."""
+    session = sessions.get(conn)
+    if session is None or session.lagging:
+        return  # Client is gone or about to be dropped
+    if session.binary:
+        data = binary_frames(data)
+    buffer = session.outbound
+    buffer += data
+    if len(buffer) > outbound_high_water:
+        # The client is not reading; drop it rather than buffer without bound
+        session.lagging = True
+        buffer.clear()
+    pending_writes.add(conn)
+
+
+def flush_outbound(conn, selector):
+    """Write as much queued output as the socket accepts without blocking."""
+    session = sessions[conn]
+    if session.lagging:
+        connection_log.warning("Closing connection: client is not reading its messages")
+        close_connection(conn, selector)
+        return
+    buffer = session.outbound
+    if buffer:
+        try:
+            sent = conn.send(buffer)
+            del buffer[:sent]
+            metrics.increment('bytes_sent_total', "Bytes written to clients", sent)
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            connection_log.warning("Write failed: %s", e)
+            close_connection(conn, selector)
+            return
+    if not buffer and session.close_when_sent:
+        close_connection(conn, selector)
+        return
+    if selector is None:
+        return  # asyncio engine: the transport buffers whatever it cannot send yet
+    # Only watch for writability while output is still waiting
+    events = selectors.EVENT_READ | selectors.EVENT_WRITE if buffer else selectors.EVENT_READ
+    if selector.get_key(conn).events != events:
+        selector.modify(conn, events, selector.get_key(conn).data)
+
+
+def flush_pending_writes(selector):
+    """Flush every connection that had output queued during this loop iteration."""
+    while pending_writes:
+        conn = pending_writes.pop()
+        if conn in sessions:
+            flush_outbound(conn, selector)
 
 
 def get_username_from_conn(conn):
-    return client_usernames.get(conn, None)  # Get the username from the new dictionary
+    session = sessions.get(conn)
+    return session.username if session is not None else None
+
+
+
+def room_owner(room_name):
+    """Return the id of the worker that owns a room."""
+    return zlib.crc32(room_name.encode()) % worker_count
+
+
+def route_to_room_owner(conn, room_name, line, selector):
+    """Move the connection to the worker that owns room_name, if that is another worker.
+
+    The owner replays line and any later buffered input. Returns True if the
+    connection was handed off. Clients seated as a player stay where their
+    game is, and handle_create and handle_join refuse them another room.
+    """
+    if worker_count == 1 or room_owner(room_name) == worker_id or get_room_for_player(conn):
+        return False
+    hand_off_connection(conn, selector, room_owner(room_name), line)
+    return True
+
+
+def hand_off_connection(conn, selector, target, line):
+    """Pass a client socket and its session state to another worker."""
+    session = sessions.pop(conn)
+    timers.cancel(session.timer)
+    leave_quickplay(conn, session)
+    if session.role == 'viewer':
+        rooms[session.room_name].viewers.remove(conn)
+    if session.binary:
+        pending_input = codec.encode_text(line) + bytes(session.inbound)
+    else:
+        pending_input = line.encode() + b"\n" + bytes(session.inbound)
+    session.inbound.clear()  # Stops process_commands from running the rest here
+    header = {
+        'type': 'handoff',
+        'username': session.username,
+        'authenticated': session.authenticated,
+        'binary': session.binary,
+        'deltas': session.deltas,
+        'input': len(pending_input),
+    }
+    pending_writes.discard(conn)
+    selector.unregister(conn)
+    send_to_peer(target, header, pending_input + bytes(session.outbound), conn)
+
+
+def adopt_connection(header, payload, fd, selector, users):
+    """Take over a client socket handed off by another worker."""
+    conn = socket.socket(fileno=fd)
+    conn.setblocking(False)
+    session = sessions[conn] = Session(conn)
+    if header['authenticated']:
+        session.authenticated = True
+        session.username = header['username']
+    session.binary = header['binary']
+    session.deltas = header['deltas']
+    session.inbound += payload[:header['input']]
+    if len(payload) > header['input']:
+        session.outbound += payload[header['input']:]
+        pending_writes.add(conn)
+    watch_connection(conn)
+    selector.register(conn, selectors.EVENT_READ, lambda conn, mask: handle_client(conn, mask, selector, users))
+    process_commands(conn, selector, users)
+
+
+def publish_room(room_name):
+    """Index a change to one of this worker's rooms and tell the other workers."""
+    room = rooms.get(room_name)
+    update_room_index(room_name, room.players if room else None)
+    if worker_count == 1:
+        return
+    header = {'type': 'room', 'name': room_name, 'players': room.players if room else None}
+    for peer_id in peer_sockets:
+        send_to_peer(peer_id, header)
+
+
+def send_to_peer(peer_id, header, payload=b"", conn=None):
+    """Queue an IPC message for another worker, optionally passing conn's socket.
+
+    A passed socket is closed here once the message has been sent.
+    """
+    header = json.dumps(header).encode()
+    data = struct.pack("!I", len(header)) + header + payload
+    peer = peer_sockets[peer_id]
+    queued = peer_outbound.setdefault(peer, [])
+    queued.append((data, conn))
+    if len(queued) == 1:
+        flush_peer(peer)
+
+
+def flush_peer(peer):
+    """Send queued IPC messages until the peer socket would block."""
+    queued = peer_outbound[peer]
+    while queued:
+        data, conn = queued[0]
+        try:
+            if conn is None:
+                peer.send(data)
+            else:
+                socket.send_fds(peer, [data], [conn.fileno()])
+        except BlockingIOError:
+            break
+        except OSError as e:
+            worker_log.error("Could not pass message to worker: %s", e)
+        queued.pop(0)
+        if conn is not None:
+            conn.close()  # The other worker holds its own copy of the descriptor now
+    selector = peer_selector
+    events = selectors.EVENT_READ | selectors.EVENT_WRITE if queued else selectors.EVENT_READ
+    if selector.get_key(peer).events != events:
+        selector.modify(peer, events, selector.get_key(peer).data)
+
+
+def handle_peer(peer, mask, selector, users):
+    """Handle IPC traffic from another worker."""
+    if mask & selectors.EVENT_WRITE:
+        flush_peer(peer)
+    if not mask & selectors.EVENT_READ:
+        return
+    while True:
+        try:
+            data, fds, _, _ = socket.recv_fds(peer, peer_message_size, 1)
+        except BlockingIOError:
+            return
+        if not data:
+            worker_log.error("Worker connection closed")
+            sys.exit(1)
+        header_length, = struct.unpack_from("!I", data)
+        header = json.loads(data[4:4 + header_length])
+        payload = data[4 + header_length:]
+        if header['type'] == 'handoff':
+            adopt_connection(header, payload, fds[0], selector, users)
+        elif header['type'] == 'room':
+            if header['players'] is None:
+                remote_rooms.pop(header['name'], None)
+            else:
+                remote_rooms[header['name']] = header['players']
+            update_room_index(header['name'], header['players'])
+        elif header['type'] == 'detached':
+            if header['held']:
+                remote_detached[header['username']] = header['worker']
+            elif remote_detached.get(header['username']) == header['worker']:
+                del remote_detached[header['username']]
+
+
+def collect_gauges():
+    """Measure the current state of the server for STATS and the metrics port."""
+    return {
+        'connections': ("Open client connections", sum(not session.scrape for session in sessions.values())),
+        'authenticated_connections': (
+            "Connections that have logged in", sum(session.authenticated for session in sessions.values())),
+        'hashing_connections': ("Connections waiting on a hash job", sum(session.paused for session in sessions.values())),
+        'rooms': ("Rooms owned by this worker", len(rooms)),
+        'remote_rooms': ("Rooms owned by other workers", len(remote_rooms)),
+        'viewers': ("Viewers in this worker's rooms", sum(len(room.viewers) for room in rooms.values())),
+        'detached_players': ("Dropped players whose seat is held for a RESUME", sum(
+            len(seats) for seats in detached_players.values())),
+        'timers': ("Login deadlines, idle checks, turn clocks and held seats scheduled", len(timers)),
+        'quickplay_waiting': ("Players waiting in the QUICKPLAY queue", len(quickplay_queue)),
+        'queued_moves': ("Out-of-turn moves waiting to be played", sum(
+            len(queue) for room in rooms.values() for queue in room.move_queues.values())),
+        'outbound_bytes': ("Output queued for clients that is not yet sent", sum(
+            len(session.outbound) for session in sessions.values())),
+    }
+
+
+def metrics_response():
+    """Build the HTTP response to a metrics scrape."""
+    body = metrics.render(collect_gauges()).encode()
+    return (
+        b"HTTP/1.0 200 OK\r\n"
+        b"Content-Type: text/plain; version=0.0.4\r\n"
+        b"Content-Length: %d\r\n\r\n" % len(body)
+    ) + body
+
+
+def create_metrics_listener(port):
+    """Listen for metrics scrapes on localhost only."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", port))
+    listener.listen()
+    listener.setblocking(False)
+    return listener
 
 
+def accept_metrics(listener, selector):
+    """Accept a metrics scrape and answer it once the request has arrived."""
+    conn, _ = listener.accept()
+    conn.setblocking(False)
+    session = sessions[conn] = Session(conn)
+    session.scrape = True
+    session.timer = timers.schedule(SCRAPE_TIMEOUT, on_scrape_deadline, conn)
+    selector.register(conn, selectors.EVENT_READ, lambda conn, mask: answer_metrics(conn, mask, selector))
+
+
+def answer_metrics(conn, mask, selector):
+    """Queue the response to a scrape once its request has arrived.
+
+    The response goes out through the same non-blocking output queue as game
+    messages, so a slow scraper never holds up the loop, and the connection
+    is closed once it has all been sent. A scraper that has not read it all
+    within SCRAPE_TIMEOUT of connecting is dropped (see on_scrape_deadline).
+    """
+    if mask & selectors.EVENT_WRITE:
+        flush_outbound(conn, selector)
+    if not mask & selectors.EVENT_READ or conn.fileno() == -1:
+        return
+    try:
+        request = conn.recv(65536)  # The request itself does not matter
+    except OSError as e:
+        metrics_log.warning("Metrics scrape failed: %s", e)
+        request = b""
+    if not request:
+        close_connection(conn, selector)
+        return
+    session = sessions[conn]
+    if not session.close_when_sent:  # Answer the first read only
+        session.close_when_sent = True
+        queue_bytes(conn, metrics_response())
+
 
-def accept_wrapper(sock, selector, users, user_file):
+def accept_wrapper(sock, selector, users):
     """Accept a new client connection."""
     conn, addr = sock.accept()
-    print(f"Accepted connection from {addr}")
+    connection_log.info("Accepted connection", extra={'peer': addr})
     conn.setblocking(False)
+    sessions[conn] = Session(conn)
+    watch_connection(conn)
     # Register client connection for reading
-    selector.register(conn, selectors.EVENT_READ, lambda conn, mask: handle_client(conn, mask, selector, users, user_file))
+    selector.register(conn, selectors.EVENT_READ, lambda conn, mask: handle_client(conn, mask, selector, users))
 
 
-def run_server(config):
-    user_file = config["userDatabase"]
-    users = load_users(user_file)
+def create_listener(port, reuse_port=False):
+    """Create the non-blocking listening socket."""
     host = ''
-    port = config["port"]
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) 
+    if reuse_port:
+        # Every worker binds its own socket; the kernel spreads connections between them
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server_socket.bind((host, port))
     server_socket.listen()
     server_socket.setblocking(False)
-    print(f"Server listening on port {port}...")
-    selector = selectors.DefaultSelector()
-    selector.register(server_socket, selectors.EVENT_READ, lambda sock, mask: accept_wrapper(sock, selector, users, user_file))
+    return server_socket
+
+
+def load_bot_table(config):
+    """Map the bot move table, solving it first if the file does not exist yet.
+
+    Done before workers fork, so they share one copy.
+    """
+    path = config['botTable']
+    if path is None:
+        return
+    try:
+        bot.load_table(path)
+    except (OSError, ValueError) as e:
+        print(f"Error: cannot load bot table {path}: {e}")
+        sys.exit(1)
+
+
+def run_server(config):
+    load_bot_table(config)
+    if config['workers'] > 1:
+        run_workers(config)
+        return
+    server_socket = create_listener(config["port"])
+    logger.info("Server listening on port %d", config['port'])
+    if config['engine'] == 'asyncio':
+        asyncio.run(serve_asyncio(config, server_socket))
+    else:
+        serve(config, server_socket)
+
+
+def run_workers(config):
+    """Fork one worker per configured core and wait on them.
+
+    Workers share the listening port through SO_REUSEPORT. Each pair of
+    workers is connected by a SOCK_SEQPACKET socket pair, used to pass client
+    sockets to the worker that owns a room and to share room listings.
+    """
+    global worker_id, worker_count, peer_message_size
+    worker_count = config['workers']
+    peer_message_size = MAX_BUFFERED_INPUT + config['outboundHighWater'] + 64 * 1024
+    links = {}
+    for i in range(worker_count):
+        for j in range(i + 1, worker_count):
+            links[i, j] = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+    children = []
+    for i in range(worker_count):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent shuts workers down
+            worker_id = i
+            for (a, b), (end_a, end_b) in links.items():
+                if a == i:
+                    peer_sockets[b] = end_a
+                    end_b.close()
+                elif b == i:
+                    peer_sockets[a] = end_b
+                    end_a.close()
+                else:
+                    end_a.close()
+                    end_b.close()
+            for peer in peer_sockets.values():
+                peer.setblocking(False)
+                peer.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, peer_message_size)
+                peer.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, peer_message_size)
+            server_socket = create_listener(config["port"], reuse_port=True)
+            worker_log.info("Worker %d listening on port %d", worker_id, config['port'])
+            try:
+                serve(config, server_socket)
+            finally:
+                gamelog.close_log()
+                serverlog.stop()
+                os._exit(1)
+        children.append(pid)
+
+    for end_a, end_b in links.values():
+        end_a.close()
+        end_b.close()
+
+    def stop_workers(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+    def forward_signal(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGUSR1, forward_signal)  # Every worker profiles itself
+    signal.signal(signal.SIGUSR2, forward_signal)
+    # Rooms live in worker memory, so a dead worker cannot be replaced transparently
+    pid, status = os.wait()
+    worker_log.error("Worker process %d exited, shutting down", pid)
+    stop_workers(None, None)
+
+
+def open_game_log(config):
+    """Start the game log if one is configured. Each worker writes its own file."""
+    path = config['gameLog']
+    if path is None:
+        return
+    if worker_count > 1:
+        path = f"{path}.{worker_id}"
+    try:
+        gamelog.open_log(path, config['gameLogFlushInterval'])
+    except (OSError, ValueError) as e:
+        print(f"Error: cannot open game log {path}: {e}")
+        sys.exit(1)
+
+
+def exit_on_signal(signum, frame):
+    sys.exit(0)
+
+
+def ignore_signal(signum, frame):
+    pass
 
+
+def run_signals(sock):
+    """Act on the signals passed to the selector loop through its wakeup socket."""
+    try:
+        signums = sock.recv(64)
+        while signums:
+            for signum in signums:
+                if signum == signal.SIGTERM:
+                    sys.exit(0)  # Runs cleanup, writing out queued log lines
+                if signum in (signal.SIGUSR1, signal.SIGUSR2):
+                    on_profile_signal(signum)
+            signums = sock.recv(64)
+    except BlockingIOError:
+        pass
+
+
+def apply_config(config):
+    """Copy the settings the handlers read into module globals."""
+    global outbound_high_water, max_rooms, max_queued_moves, bcrypt_rounds, admin_users, profile_directory
+    global token_ttl, resume_grace, login_timeout, idle_timeout, turn_timeout, bots_enabled, quickplay_bot_delay
+    outbound_high_water = config['outboundHighWater']
+    max_rooms = config['maxRooms']
+    max_queued_moves = config['maxQueuedMoves']
+    bcrypt_rounds = config['bcryptRounds']
+    admin_users = set(config['adminUsers'])
+    profile_directory = config['profileDirectory']
+    token_ttl = config['sessionTokenTTL']
+    resume_grace = config['resumeGracePeriod']
+    login_timeout = config['loginTimeout']
+    idle_timeout = config['idleTimeout']
+    turn_timeout = config['turnTimeout']
+    bots_enabled = config['botTable'] is not None
+    quickplay_bot_delay = config['quickplayBotDelay']
+
+
+def serve(config, server_socket):
+    """Run the selector loop for one server process."""
+    global peer_selector, signal_wakeup_reader, signal_wakeup_writer
+    apply_config(config)
+    serverlog.start()
+    signal.signal(signal.SIGTERM, exit_on_signal)  # Until the loop runs; cleanup writes out queued log lines
+    open_game_log(config)
+    users = open_user_store(config)
+    selector = selectors.DefaultSelector()
+    peer_selector = selector
+    start_hash_pool(config)
+    selector.register(hash_wakeup_reader, selectors.EVENT_READ, lambda sock, mask: run_completed_hash_jobs())
+    selector.register(server_socket, selectors.EVENT_READ, lambda sock, mask: accept_wrapper(sock, selector, users))
+    for peer in peer_sockets.values():
+        peer_outbound[peer] = []
+        selector.register(peer, selectors.EVENT_READ, lambda peer, mask: handle_peer(peer, mask, selector, users))
+    if config['metricsPort'] is not None:
+        listener = create_metrics_listener(config['metricsPort'] + worker_id)
+        selector.register(listener, selectors.EVENT_READ, lambda sock, mask: accept_metrics(sock, selector))
+    signal_wakeup_reader, signal_wakeup_writer = socket.socketpair()
+    signal_wakeup_reader.setblocking(False)
+    signal_wakeup_writer.setblocking(False)
+    signal.set_wakeup_fd(signal_wakeup_writer.fileno(), warn_on_full_buffer=False)
+    selector.register(signal_wakeup_reader, selectors.EVENT_READ, lambda sock, mask: run_signals(sock))
+    for signum in (signal.SIGTERM, signal.SIGUSR1, signal.SIGUSR2):
+        signal.signal(signum, ignore_signal)
+
+    loop_busy = metrics.histogram('loop_iteration_seconds', "Time spent handling one selector loop iteration's events")
+    loop_lag = metrics.histogram('loop_lag_seconds', "How late the loop woke for a tick due every second")
+    next_tick = time.perf_counter() + LOOP_TICK
     while True:
-        events = selector.select()
+        timeout = next_tick - time.perf_counter()
+        timer_timeout = timers.timeout()
+        if timer_timeout is not None:
+            timeout = min(timeout, timer_timeout)
+        events = selector.select(max(0.0, timeout))
+        started = time.perf_counter()
         for key, mask in events:
             callback = key.data
             callback(key.fileobj, mask)
+        timers.advance()
+        flush_pending_writes(selector)
+        now = time.perf_counter()
+        loop_busy.observe(now - started)
+        if now >= next_tick:
+            loop_lag.observe(now - next_tick)
+            next_tick = now + LOOP_TICK
+
+class StreamConnection:
+    """A client connection served by the asyncio engine.
+
+    Provides the fileno/send/close subset of the socket API that the
+    command handlers and output queues use, so they run unchanged.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self._fileno = writer.get_extra_info('socket').fileno()
+
+    def fileno(self):
+        return -1 if self.writer.is_closing() else self._fileno
+
+    def send(self, data):
+        # The transport buffers everything; apply the same high-water mark to it
+        if self.writer.transport.get_write_buffer_size() > outbound_high_water:
+            raise ConnectionError("client is not reading its messages")
+        # A copy: the transport may keep a view of what it could not send
+        # yet, and flush_outbound deletes the sent bytes from data
+        self.writer.write(bytes(data))
+        return len(data)
+
+    def close(self):
+        self.writer.close()
+
+
+async def serve_asyncio(config, server_socket):
+    """Serve clients over asyncio streams with the same command handlers."""
+    apply_config(config)
+    serverlog.start()
+    open_game_log(config)
+    users = open_user_store(config)
+    loop = asyncio.get_running_loop()
+    # Stop between callbacks rather than raising SystemExit inside one;
+    # asyncio.run then cancels the connection tasks and atexit does the rest
+    stopping = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    start_hash_pool(config)
+
+    def on_hash_wakeup():
+        run_completed_hash_jobs()
+        flush_pending_writes(None)
+    loop.add_reader(hash_wakeup_reader, on_hash_wakeup)
+    loop.add_signal_handler(signal.SIGUSR1, on_profile_signal, signal.SIGUSR1)
+    loop.add_signal_handler(signal.SIGUSR2, on_profile_signal, signal.SIGUSR2)
+
+    async def handle_stream(reader, writer):
+        conn = StreamConnection(reader, writer)
+        sessions[conn] = Session(conn)
+        watch_connection(conn)
+        connection_log.info("Accepted connection", extra={'peer': writer.get_extra_info('peername')})
+        while conn.fileno() != -1:
+            try:
+                data = await reader.read(8192)
+            except OSError as e:
+                connection_log.warning("Read failed: %s", e)
+                data = b""
+            except asyncio.CancelledError:
+                # Shutting down. Returning rather than re-raising spares
+                # asyncio's stream callback from logging the cancellation.
+                return
+            receive_data(conn, data, None, users)
+            flush_pending_writes(None)
+
+    async def answer_scrape(reader, writer):
+        try:
+            # The request itself does not matter
+            if await asyncio.wait_for(reader.read(65536), SCRAPE_TIMEOUT):
+                writer.write(metrics_response())
+                await asyncio.wait_for(writer.drain(), SCRAPE_TIMEOUT)
+        except asyncio.TimeoutError:
+            metrics.increment('connections_timed_out_total', "Connections closed by a deadline, by reason",
+                              labels=(('reason', 'scrape'),))
+            metrics_log.info("Closing metrics connection: scrape not done within %s seconds", SCRAPE_TIMEOUT)
+        except OSError as e:
+            metrics_log.warning("Metrics scrape failed: %s", e)
+        writer.close()
+
+    async def watch_loop_lag():
+        loop_lag = metrics.histogram('loop_lag_seconds', "How late the loop woke for a tick due every second")
+        while True:
+            due = time.perf_counter() + LOOP_TICK
+            await asyncio.sleep(LOOP_TICK)
+            loop_lag.observe(max(0.0, time.perf_counter() - due))
+
+    async def run_timers():
+        while True:
+            timeout = timers.timeout()
+            await asyncio.sleep(TIMER_TICK if timeout is None else timeout)
+            if timers.advance():
+                flush_pending_writes(None)
+
+    lag_watcher = asyncio.create_task(watch_loop_lag())
+    timer_runner = asyncio.create_task(run_timers())
+    servers = [await asyncio.start_server(handle_stream, sock=server_socket)]
+    if config['metricsPort'] is not None:
+        servers.append(await asyncio.start_server(answer_scrape, "127.0.0.1", config['metricsPort']))
+    await stopping.wait()
+    for server in servers:
+        server.close()
+
 
 if __name__ == "__main__":
     if len(sys.argv) != 2:
@@ -535,4 +2137,5 @@ if __name__ == "__main__":
         sys.exit(1)
     config_path = sys.argv[1]
     config = load_config(config_path)
+    serverlog.configure(config)
     run_server(config)
\ No newline at end of file
@@ -0,0 +1,161 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+import metrics
+
+
+__all__ = [
+    "CATEGORIES",
+    "FORMATS",
+    "TextFormatter",
+    "JsonFormatter",
+    "RateLimitFilter",
+    "configure",
+    "start",
+    "stop",
+]
+
+
+# Every server logger is "server.<category>", and each category can be given
+# its own level with the logLevels setting.
+ROOT = "server"
+CATEGORIES = ("connection", "auth", "room", "game", "worker", "metrics", "profile")
+FORMATS = ("text", "json")
+QUEUE_SIZE = 10000  # Lines waiting for the writer thread; more are dropped
+RATE_WINDOW = 10.0  # Seconds over which logRateLimit counts repeats of a line
+
+# Attributes every LogRecord has; anything else was passed with extra= and
+# is written out as a field
+_STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_handler = None  # Writes to stdout, on the calling thread until start()
+_listener = None
+_rate_limit = 0
+
+
+def _fields(record: logging.LogRecord) -> dict:
+    return {key: value for key, value in vars(record).items() if key not in _STANDARD_ATTRIBUTES}
+
+
+class TextFormatter(logging.Formatter):
+    """time level logger message, then any fields as key=value"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = _fields(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with any fields as extra keys"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(_fields(record))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Let through at most limit copies of the same warning or error per RATE_WINDOW.
+
+    The first copy after a quiet window carries a suppressed field with the
+    number of copies dropped in the window before it.
+    """
+
+    def __init__(self, limit: int):
+        super().__init__()
+        self.limit = limit
+        self.seen = {}  # (logger, message) -> [window start, copies seen]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+        now = time.monotonic()
+        key = (record.name, record.getMessage())
+        entry = self.seen.get(key)
+        if entry is not None and now - entry[0] < RATE_WINDOW:
+            entry[1] += 1
+            return entry[1] <= self.limit
+        if entry is not None and entry[1] > self.limit:
+            record.suppressed = entry[1] - self.limit
+        if len(self.seen) >= QUEUE_SIZE:  # Forget lines whose window is over
+            self.seen = {k: e for k, e in self.seen.items() if now - e[0] < RATE_WINDOW}
+        self.seen[key] = [now, 1]
+        return True
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread, dropping them if it has fallen behind."""
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.increment('log_lines_dropped_total', "Log lines dropped because the log writer fell behind")
+
+
+def _install(handler: logging.Handler):
+    if _rate_limit:
+        handler.addFilter(RateLimitFilter(_rate_limit))
+    logging.getLogger(ROOT).handlers = [handler]
+
+
+def configure(config: dict):
+    """Set up the server loggers from the logLevel, logLevels, logFormat and logRateLimit settings.
+
+    Until start() is called, lines are written on the thread that logs them.
+    """
+    global _handler, _rate_limit
+    root = logging.getLogger(ROOT)
+    root.setLevel(config['logLevel'])
+    root.propagate = False
+    for category, level in config['logLevels'].items():
+        logging.getLogger(f"{ROOT}.{category}").setLevel(level)
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(JsonFormatter() if config['logFormat'] == 'json' else TextFormatter())
+    _rate_limit = config['logRateLimit']
+    _install(_handler)
+
+
+def start():
+    """Move writing to a background thread, so a slow stdout never stalls the event loop.
+
+    Call this in each process that runs an event loop, after any fork.
+    """
+    global _listener
+    if _listener is not None or _handler is None:
+        return
+    lines = queue.Queue(QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(lines, _handler)
+    _listener.start()
+    _install(_DroppingQueueHandler(lines))
+    atexit.register(stop)
+
+
+def stop():
+    """Write out every queued line and go back to writing on the calling thread"""
+    global _listener
+    if _listener is None:
+        return
+    _install(_handler)
+    _listener.stop()
+    _listener = None
@@ -0,0 +1,74 @@
+import unittest
+
+import bitboard
+import game
+
+
+def line_wins(player, board):
+    """The row, column and diagonal check game.py used before bitboards."""
+    size = len(board)
+    return (
+        any(all(board[y][x] == player for y in range(size)) for x in range(size)) or
+        any(all(board[y][x] == player for x in range(size)) for y in range(size)) or
+        all(board[i][i] == player for i in range(size)) or
+        all(board[i][size - 1 - i] == player for i in range(size))
+    )
+
+
+def reachable_boards():
+    """Every board that can occur in play, X moving first, with no moves after a win."""
+    seen = set()
+    boards = []
+
+    def visit(board, player):
+        key = tuple(map(tuple, board))
+        if key in seen:
+            return
+        seen.add(key)
+        boards.append([row[:] for row in board])
+        if line_wins(game.CROSS, board) or line_wins(game.NOUGHT, board):
+            return
+        following = game.NOUGHT if player == game.CROSS else game.CROSS
+        for y in range(3):
+            for x in range(3):
+                if board[y][x] == game.EMPTY:
+                    board[y][x] = player
+                    visit(board, following)
+                    board[y][x] = game.EMPTY
+
+    visit(game.create_board(), game.CROSS)
+    return boards
+
+
+class BitboardTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.boards = reachable_boards()
+
+    def test_every_reachable_board_is_visited(self):
+        self.assertEqual(len(self.boards), 5478)
+
+    def test_wins_and_is_full_match_the_line_checks(self):
+        for board in self.boards:
+            x_mask, o_mask = bitboard.masks_from_rows(board, game.CROSS, game.NOUGHT)
+            self.assertEqual(bitboard.wins(x_mask), line_wins(game.CROSS, board), board)
+            self.assertEqual(bitboard.wins(o_mask), line_wins(game.NOUGHT, board), board)
+            full = all(cell != game.EMPTY for row in board for cell in row)
+            self.assertEqual(bitboard.is_full(x_mask, o_mask), full, board)
+
+    def test_game_functions_match_the_line_checks(self):
+        for board in self.boards:
+            self.assertEqual(game.player_wins(game.CROSS, board), line_wins(game.CROSS, board), board)
+            self.assertEqual(game.player_wins(game.NOUGHT, board), line_wins(game.NOUGHT, board), board)
+            self.assertEqual(game.players_draw(board), all(game.EMPTY not in row for row in board), board)
+
+    def test_board_string_matches_the_cells(self):
+        digits = {game.EMPTY: '0', game.CROSS: '1', game.NOUGHT: '2'}
+        for board in self.boards:
+            x_mask, o_mask = bitboard.masks_from_rows(board, game.CROSS, game.NOUGHT)
+            expected = ''.join(digits[cell] for row in board for cell in row)
+            self.assertEqual(bitboard.board_string(x_mask, o_mask), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+import unittest
+
+import codec
+
+
+# One text message for every entry in codec.MESSAGES, and then some
+LINES = [
+    "LOGIN:alice:secret",
+    "REGISTER:bob:hunter2",
+    "ROOMLIST:PLAYER",
+    "ROOMLIST:VIEWER:2:ro",
+    "CREATE:room 1",
+    "JOIN:room 1:VIEWER",
+    "PLACE:2:1",
+    "FORFEIT",
+    "BOARDSYNC",
+    "QUICKPLAY",
+    "QUICKPLAY:CANCEL",
+    "BOT",
+    "BEGIN:alice:bob",
+    "INPROGRESS:alice:Waiting for player 2",
+    "BOARDSTATUS:120010002",
+    "GAMEEND:120210021:0:alice",
+    "GAMEEND:121212000:2",
+    "NOROOM",
+    "BADAUTH",
+    "BOARDDELTA:4:8:2",
+    "BOARDSNAPSHOT:3:100020001",
+    "LOGIN:ACKSTATUS:0",
+    "JOIN:ACKSTATUS:2",
+    "ROOMLIST:ACKSTATUS:0:Rooms available to join as PLAYER: a,b,c",
+    "PROTO:ACKSTATUS:0",
+    "STATS:ACKSTATUS:0:{\"connections\": 1}",
+    "SOMETHING:else:entirely",
+]
+
+
+def frames_of(data):
+    """Split encoded output into frame bodies with split_frame."""
+    bodies = []
+    while data:
+        body, size = codec.split_frame(data)
+        bodies.append(body)
+        data = data[size:]
+    return bodies
+
+
+class RoundTripTest(unittest.TestCase):
+    def test_every_message_survives_a_round_trip(self):
+        for line in LINES:
+            with self.subTest(line=line):
+                frame = codec.encode_text(line)
+                self.assertEqual(len(frames_of(frame)), 1)
+                body, size = codec.split_frame(frame)
+                self.assertEqual(size, len(frame))
+                self.assertEqual(codec.to_text(codec.decode(body)), line)
+                self.assertEqual(codec.split_message(frame), (codec.decode(body), len(frame)))
+
+    def test_fields_are_decoded_as_values(self):
+        self.assertEqual(codec.decode(codec.encode_text("PLACE:2:1")[2:]), ("PLACE", 2, 1))
+        self.assertEqual(codec.decode(codec.encode_text("BOARDSTATUS:120000000")[2:]),
+                         ("BOARDSTATUS", (0b1, 0b10)))
+        self.assertEqual(codec.decode(codec.encode_text("JOIN:ACKSTATUS:2")[2:]), ("JOIN", "ACKSTATUS", 2))
+
+    def test_encode_lines_frames_each_line(self):
+        data = "".join(line + "\n" for line in LINES).encode()
+        frames = codec.encode_lines(data)
+        decoded = []
+        while frames:
+            parts, size = codec.split_message(frames)
+            decoded.append(codec.to_text(parts))
+            frames = frames[size:]
+        self.assertEqual(decoded, LINES)
+
+
+class SizeLimitTest(unittest.TestCase):
+    def test_long_messages_are_split_across_frames(self):
+        piece = codec.MAX_FRAME_LENGTH - 1
+        for text_length in (piece - 1, piece, piece + 1, 2 * piece, 2 * piece + 1, 300000):
+            for prefix in ("ROOMLIST:ACKSTATUS:0:", "GAMEEND:120210021:0:", "NOTICE:"):
+                line = prefix + "r" * (text_length - len(prefix))
+                with self.subTest(text_length=text_length, prefix=prefix):
+                    data = codec.encode_text(line)
+                    for body in frames_of(data):
+                        self.assertLessEqual(len(body), codec.MAX_FRAME_LENGTH)
+                    parts, size = codec.split_message(data)
+                    self.assertEqual(size, len(data))
+                    self.assertEqual(codec.to_text(parts), line)
+
+    def test_long_text_splits_inside_a_character(self):
+        line = "NOTICE:" + "é" * 70000
+        data = codec.encode_text(line)
+        self.assertGreater(len(frames_of(data)), 1)
+        self.assertEqual(codec.to_text(codec.split_message(data)[0]), line)
+
+    def test_split_message_waits_for_every_frame(self):
+        data = codec.encode_text("NOTICE:" + "x" * 150000) + codec.encode_text("NOROOM")
+        for cut in (0, 1, 2, 65537, 65538, 131075, len(data) - 5):
+            self.assertEqual(codec.split_message(data[:cut]), (None, 0))
+        parts, size = codec.split_message(data)
+        self.assertEqual(codec.split_message(data[size:]), (("NOROOM",), len(data) - size))
+
+    def test_continued_text_must_end_with_a_text_frame(self):
+        data = codec.encode_text("NOTICE:" + "x" * 70000)
+        first = frames_of(data)[0]
+        with self.assertRaises(ValueError):
+            codec.split_message(data[:2 + len(first)] + codec.encode_text("NOROOM"))
+
+
+class MalformedFrameTest(unittest.TestCase):
+    def test_empty_frame(self):
+        with self.assertRaises(ValueError):
+            codec.decode(b"")
+
+    def test_unknown_opcode(self):
+        for opcode in (0x0E, codec.CONTINUED, 0x7F, 0xFF):
+            with self.subTest(opcode=opcode):
+                with self.assertRaises(ValueError):
+                    codec.decode(bytes([opcode]))
+
+    def test_unknown_command_in_ackstatus(self):
+        with self.assertRaises(ValueError):
+            codec.decode(bytes([codec.ACKSTATUS, 0x7F, 0, 0]))
+
+    def test_truncated_frames(self):
+        for line in LINES:
+            body = codec.split_frame(codec.encode_text(line))[0]
+            if body[0] == codec.TEXT:
+                continue  # Any prefix of text is still text
+            for cut in range(1, len(body)):
+                with self.subTest(line=line, cut=cut):
+                    with self.assertRaises(ValueError):
+                        codec.decode(body[:cut])
+
+    def test_trailing_bytes(self):
+        body = codec.split_frame(codec.encode_text("PLACE:2:1"))[0]
+        with self.assertRaises(ValueError):
+            codec.decode(body + b"\0")
+
+    def test_invalid_utf8(self):
+        with self.assertRaises(ValueError):
+            codec.decode(bytes([codec.TEXT]) + b"\xff\xfe")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import os
+import tempfile
+import unittest
+
+import gamelog
+
+
+GAMES = [
+    # (game id, events after CREATE), ending in a win, a draw, a forfeit and not at all
+    (11, [("JOIN", "bob", 1), ("JOIN", "carol", 0), ("PLACE", 1, 0), ("PLACE", 2, 4),
+          ("PLACE", 1, 1), ("PLACE", 2, 8), ("PLACE", 1, 2), ("GAMEEND", 0, "alice", 0b111, 0b100010000)]),
+    (12, [("JOIN", "bob", 1), ("GAMEEND", 1, "", 0b101011010, 0b010100101)]),
+    (13, [("JOIN", "bob", 1), ("PLACE", 1, 4), ("GAMEEND", 2, "bob", 0b10000, 0)]),
+    (14, [("JOIN", "bob", 1), ("PLACE", 1, 4)]),
+]
+
+
+class GameLogTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, "games.log")
+        self.addCleanup(gamelog.close_log)
+
+    def write_games(self, games):
+        gamelog.open_log(self.path, 60)  # Nothing is committed before close_log
+        expected = []
+        for game_id, events in games:
+            gamelog.record("CREATE", game_id, f"room {game_id}", "alice")
+            expected.append(("CREATE", game_id, (f"room {game_id}", "alice")))
+            for kind, *fields in events:
+                gamelog.record(kind, game_id, *fields)
+                expected.append((kind, game_id, tuple(fields)))
+        gamelog.close_log()
+        return expected
+
+    def read_back(self, kinds=None):
+        return [(event.kind, event.game_id, event.fields) for event in gamelog.read_events(self.path, kinds)]
+
+    def test_events_read_back_in_order(self):
+        expected = self.write_games(GAMES)
+        self.assertEqual(self.read_back(), expected)
+
+    def test_kind_filter(self):
+        expected = self.write_games(GAMES)
+        for kinds in (["PLACE"], ["CREATE", "GAMEEND"], []):
+            with self.subTest(kinds=kinds):
+                self.assertEqual(self.read_back(kinds), [event for event in expected if event[0] in kinds])
+
+    def test_count_results(self):
+        self.write_games(GAMES)
+        self.assertEqual(gamelog.count_results([self.path]), (4, [1, 1, 1]))
+        self.assertEqual(gamelog.count_results([self.path, self.path]), (8, [2, 2, 2]))
+
+    def test_replay(self):
+        self.write_games(GAMES)
+        games = gamelog.replay([self.path])
+        self.assertEqual(sorted(games), [11, 12, 13, 14])
+        won = games[11]
+        self.assertEqual((won.room, won.player1, won.player2, won.viewers), ("room 11", "alice", "bob", ["carol"]))
+        self.assertEqual((won.status, won.winner, len(won.moves)), (0, "alice", 5))
+        self.assertEqual((games[12].status, games[12].winner), (1, None))
+        self.assertIsNone(games[14].status)
+        self.assertEqual(list(gamelog.replay([self.path], 13)), [13])
+
+    def test_empty_log(self):
+        self.write_games([])
+        with open(self.path, "rb") as file:
+            self.assertEqual(file.read(), gamelog.MAGIC)
+        self.assertEqual(self.read_back(), [])
+        self.assertEqual(gamelog.count_results([self.path]), (0, [0, 0, 0]))
+
+    def test_torn_final_event_is_cut_off_on_reopen(self):
+        self.write_games(GAMES[:1])
+        with open(self.path, "rb") as file:
+            data = file.read()
+        last = gamelog.encode_event("GAMEEND", 11, (0, "alice", 0b111, 0b100010000))
+        boundary = len(data) - len(last)
+        for cut in range(boundary + 1, len(data)):
+            with self.subTest(cut=cut):
+                with open(self.path, "wb") as file:
+                    file.write(data[:cut])
+                # Readers skip the torn event before the log is repaired
+                self.assertEqual(len(self.read_back()), 8)
+                with self.assertLogs("server.game", "WARNING"):
+                    gamelog.open_log(self.path, 60)
+                self.assertEqual(os.path.getsize(self.path), boundary)
+                gamelog.record("GAMEEND", 11, 2, "bob", 0b1, 0b10)
+                gamelog.close_log()
+                events = self.read_back()
+                self.assertEqual(len(events), 9)
+                self.assertEqual(events[-1], ("GAMEEND", 11, (2, "bob", 0b1, 0b10)))
+                self.assertEqual(gamelog.count_results([self.path]), (1, [0, 0, 1]))
+
+    def test_reopening_an_intact_log_appends(self):
+        first = self.write_games(GAMES[:2])
+        second = self.write_games(GAMES[2:])
+        self.assertEqual(self.read_back(), first + second)
+
+    def test_not_a_game_log(self):
+        with open(self.path, "wb") as file:
+            file.write(b"something else entirely")
+        with self.assertRaises(ValueError):
+            gamelog.open_log(self.path, 60)
+        with self.assertRaises(ValueError):
+            list(gamelog.read_events(self.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
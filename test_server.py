@@ -0,0 +1,189 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import server
+
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class ViewKeepingWriter:
+    """Stands in for an asyncio StreamWriter whose transport keeps a view of
+    the data it has not sent, as the selector transport does on Python 3.12."""
+
+    def __init__(self):
+        self.views = []
+
+    def write(self, data):
+        self.views.append(memoryview(data))
+
+
+class ViewKeepingTransport:
+    def get_write_buffer_size(self):
+        return 0
+
+
+class StreamConnectionTest(unittest.TestCase):
+    def test_send_leaves_the_outbound_buffer_free_to_shrink(self):
+        conn = server.StreamConnection.__new__(server.StreamConnection)
+        conn.writer = ViewKeepingWriter()
+        conn.writer.transport = ViewKeepingTransport()
+        buffer = bytearray(b"BOARDSTATUS:100000000\n" * 4)
+        sent = conn.send(buffer)
+        del buffer[:sent]  # What flush_outbound does; BufferError if the view is of buffer
+        self.assertEqual(buffer, b"")
+        self.assertEqual(bytes(conn.writer.views[0]), b"BOARDSTATUS:100000000\n" * 4)
+
+
+class Client:
+    """A text protocol connection to the server under test."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.lines = []
+        self.pending = b""
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def read_lines(self, count):
+        while len(self.lines) < count:
+            data = self.sock.recv(1 << 20)
+            if not data:
+                break
+            *complete, self.pending = (self.pending + data).split(b"\n")
+            self.lines.extend(complete)
+        lines, self.lines = self.lines[:count], self.lines[count:]
+        return lines
+
+    def close(self):
+        self.sock.close()
+
+
+class ServerTestCase(unittest.TestCase):
+    """Runs server.py in a subprocess, with config() on top of a test config."""
+
+    RECEIVE_BUFFER = None  # SO_RCVBUF for client sockets, if set
+
+    def config(self):
+        return {}
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.port = free_port()
+        config_path = os.path.join(self.directory.name, "config.json")
+        with open(config_path, "w") as file:
+            json.dump({
+                "port": self.port,
+                "userDatabase": os.path.join(self.directory.name, "users.json"),
+                "bcryptRounds": 4,
+                "logLevel": "WARNING",
+                **self.config(),
+            }, file)
+        self.server = subprocess.Popen([sys.executable, SERVER, config_path],
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        self.addCleanup(self.server.wait)
+        self.addCleanup(self.server.terminate)
+
+    def connect(self):
+        deadline = time.monotonic() + 10
+        while True:
+            sock = socket.socket()
+            try:
+                if self.RECEIVE_BUFFER:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECEIVE_BUFFER)
+                sock.connect(("127.0.0.1", self.port))
+                break
+            except ConnectionRefusedError:
+                sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        sock.settimeout(10)
+        client = Client(sock)
+        self.addCleanup(client.close)
+        return client
+
+    def log_in(self, username):
+        client = self.connect()
+        client.send(f"REGISTER:{username}:pw\n".encode())
+        self.assertEqual(client.read_lines(1), [b"REGISTER:ACKSTATUS:0"])
+        client.send(f"LOGIN:{username}:pw\n".encode())
+        self.assertTrue(client.read_lines(1)[0].startswith(b"LOGIN:ACKSTATUS:0:"))
+        return client
+
+
+class PipelinedOutputTest(ServerTestCase):
+    """Pipelined commands whose replies outrun the socket, so the asyncio
+    transport is still buffering output when more is written to it."""
+
+    COMMANDS = 10000
+    # A small receive buffer, so the server cannot hand the replies straight to the kernel
+    RECEIVE_BUFFER = 16 * 1024
+
+    def config(self):
+        return {"engine": "asyncio", "adminUsers": ["admin"], "outboundHighWater": 64 * 1024 * 1024}
+
+    def test_every_reply_arrives(self):
+        admin = self.log_in("admin")
+        # Sent without reading any replies, which come to megabytes
+        admin.send(b"STATS\n" * self.COMMANDS)
+        replies = admin.read_lines(self.COMMANDS)
+        self.assertEqual(len(replies), self.COMMANDS)
+        self.assertTrue(all(reply.startswith(b"STATS:ACKSTATUS:0:") for reply in replies))
+        self.assertIsNone(self.server.poll())
+
+
+class WaitingPlayerTest(ServerTestCase):
+    """A player alone in a room cannot move, so a bot or a second player
+    never joins a game that is already under way."""
+
+    def config(self):
+        return {"botTable": os.path.join(self.directory.name, "bot-moves.bin")}
+
+    def create_room(self):
+        alice = self.log_in("alice")
+        alice.send(b"CREATE:room\n")
+        self.assertEqual(alice.read_lines(1), [b"CREATE:ACKSTATUS:0"])
+        alice.send(b"PLACE:0:0\n")
+        self.assertEqual(alice.read_lines(1), [b"PLACE:ACKSTATUS:5"])
+        return alice
+
+    def test_place_before_a_bot_is_seated(self):
+        alice = self.create_room()
+        alice.send(b"BOT\n")
+        self.assertEqual(alice.read_lines(2), [b"BOT:ACKSTATUS:0", b"BEGIN:alice:bot"])
+        alice.send(b"PLACE:1:0\n")
+        # Alice's X, then the bot's O
+        mine, reply = alice.read_lines(2)
+        self.assertEqual(mine, b"BOARDSTATUS:010000000")
+        board = reply.partition(b":")[2]
+        self.assertEqual((board.count(b"1"), board.count(b"2"), board[1:2]), (1, 1, b"1"))
+        self.assertIsNone(self.server.poll())
+
+    def test_place_before_a_second_player_joins(self):
+        alice = self.create_room()
+        bob = self.log_in("bob")
+        bob.send(b"JOIN:room:PLAYER\n")
+        self.assertEqual(bob.read_lines(2), [b"JOIN:ACKSTATUS:0", b"BEGIN:alice:bob"])
+        self.assertEqual(alice.read_lines(1), [b"BEGIN:alice:bob"])
+        alice.send(b"PLACE:0:0\n")
+        self.assertEqual(alice.read_lines(1), [b"BOARDSTATUS:100000000"])
+        self.assertEqual(bob.read_lines(1), [b"BOARDSTATUS:100000000"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import unittest
+from unittest import mock
+
+import timerwheel
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch("timerwheel.time.monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # One-second ticks and a short wheel, so a turn is 8 seconds
+        self.wheel = timerwheel.TimerWheel(tick=1.0, slots=8)
+        self.fired = []
+
+    def schedule(self, delay, name):
+        return self.wheel.schedule(delay, self.fired.append, name)
+
+    def run_until(self, when, step=1.0):
+        """Advance the clock to when, calling advance() every step seconds."""
+        while self.clock.now + step <= when:
+            self.clock.now += step
+            self.wheel.advance()
+        self.clock.now = when
+        self.wheel.advance()
+
+    def test_fires_in_its_tick_and_never_early(self):
+        self.schedule(2.5, "a")
+        self.run_until(1002.99, step=0.25)
+        self.assertEqual(self.fired, [])
+        self.run_until(1003.0)
+        self.assertEqual(self.fired, ["a"])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_zero_delay_fires_on_the_next_tick(self):
+        self.schedule(0, "a")
+        self.assertEqual(self.wheel.advance(), 0)
+        self.run_until(1001.0)
+        self.assertEqual(self.fired, ["a"])
+
+    def test_firing_order(self):
+        for delay, name in ((5, "e"), (1, "a"), (3, "c"), (3, "d"), (2, "b")):
+            self.schedule(delay, name)
+        self.run_until(1010.0)
+        self.assertEqual(self.fired, ["a", "b", "c", "d", "e"])
+
+    def test_firing_order_after_a_stall(self):
+        # The due timers sit in slots that wrap around the wheel
+        for delay, name in ((7, "d"), (1, "a"), (12, "f"), (6, "c"), (3, "b"), (9, "e"), (30, "late")):
+            self.schedule(delay, name)
+        self.clock.now += 20
+        self.assertEqual(self.wheel.advance(), 6)
+        self.assertEqual(self.fired, ["a", "b", "c", "d", "e", "f"])
+        self.assertEqual(len(self.wheel), 1)
+
+    def test_deadlines_beyond_one_turn(self):
+        for delay in (8, 9, 17, 25):
+            self.schedule(delay, delay)
+        ticks = {}
+        while len(self.wheel):
+            self.run_until(self.clock.now + 1)
+            for delay in self.fired:
+                ticks.setdefault(delay, self.clock.now - 1000)
+        self.assertEqual(ticks, {8: 8, 9: 9, 17: 17, 25: 25})
+
+    def test_deadline_beyond_one_turn_after_a_stall(self):
+        self.schedule(20, "a")
+        self.clock.now += 19
+        self.assertEqual(self.wheel.advance(), 0)
+        self.clock.now += 1
+        self.assertEqual(self.wheel.advance(), 1)
+
+    def test_cancel(self):
+        first = self.schedule(2, "a")
+        second = self.schedule(2, "b")
+        self.assertEqual(len(self.wheel), 2)
+        self.wheel.cancel(first)
+        self.wheel.cancel(first)  # Already cancelled
+        self.wheel.cancel(None)
+        self.assertEqual(len(self.wheel), 1)
+        self.run_until(1005.0)
+        self.assertEqual(self.fired, ["b"])
+        self.wheel.cancel(second)  # Already fired
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_reschedule(self):
+        # Pushing a deadline back is a cancel and a new schedule, as the server's idle check does
+        timer = self.schedule(3, "a")
+        self.run_until(1002.0)
+        self.wheel.cancel(timer)
+        timer = self.schedule(3, "a")
+        self.run_until(1004.0)
+        self.assertEqual(self.fired, [])
+        self.run_until(1005.0)
+        self.assertEqual(self.fired, ["a"])
+
+    def test_callback_that_cancels_a_due_timer(self):
+        later = self.schedule(2, "b")
+        self.wheel.schedule(1, lambda: self.wheel.cancel(later))
+        self.clock.now += 5
+        self.assertEqual(self.wheel.advance(), 1)
+        self.assertEqual(self.fired, [])
+
+    def test_callback_that_schedules_waits_for_a_later_advance(self):
+        self.wheel.schedule(1, lambda: self.schedule(0, "again"))
+        self.run_until(1001.0)
+        self.assertEqual(self.fired, [])
+        self.run_until(1002.0)
+        self.assertEqual(self.fired, ["again"])
+
+    def test_timeout(self):
+        self.assertIsNone(self.wheel.timeout())
+        self.schedule(5, "a")
+        self.clock.now = 1000.25
+        self.assertEqual(self.wheel.timeout(), 0.75)
+        self.clock.now = 1003.5  # Late for the next tick
+        self.assertEqual(self.wheel.timeout(), 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
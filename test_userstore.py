@@ -0,0 +1,68 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+
+import userstore
+
+
+class IterJsonArrayTest(unittest.TestCase):
+    def parse(self, text, chunk_size):
+        return list(userstore.iter_json_array(io.StringIO(text), chunk_size=chunk_size))
+
+    def test_values_split_across_every_chunk_boundary(self):
+        values = [
+            {"username": "alice", "password": "x" * 40},
+            2.5,
+            -1e-3,
+            "quoted \"text\" with \\ and , and ]",
+            [1, [2, 3]],
+            None,
+            True,
+            12345678901234567890,
+        ]
+        text = json.dumps(values, indent=4)
+        for chunk_size in range(1, len(text) + 2):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.parse(text, chunk_size), values)
+
+    def test_number_at_the_end_of_a_chunk_is_not_cut_short(self):
+        self.assertEqual(self.parse("[2.5, 10]", 3), [2.5, 10])
+
+    def test_empty_array(self):
+        self.assertEqual(self.parse(" [ ] ", 1), [])
+
+    def test_empty_file_has_no_values(self):
+        self.assertEqual(self.parse("", 4), [])
+        self.assertEqual(self.parse(" \n\t", 1), [])
+
+    def test_malformed_input_raises_value_error(self):
+        for text in ("{}", "[1 2]", "[1,", "[", "[1"):
+            with self.subTest(text=text):
+                with self.assertRaises(ValueError):
+                    self.parse(text, 2)
+
+
+class JsonUserStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, "users.json")
+
+    def test_empty_file_loads_as_no_users(self):
+        open(self.path, "w").close()
+        store = userstore.JsonUserStore(self.path)
+        self.assertIsNone(store.get("alice"))
+        self.assertTrue(store.add("alice", "hash"))
+        self.assertEqual(userstore.JsonUserStore(self.path).get("alice")["password"], "hash")
+
+    def test_invalid_file_exits(self):
+        with open(self.path, "w") as file:
+            file.write("{}")
+        with self.assertRaises(SystemExit):
+            userstore.JsonUserStore(self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+"""Hashed timing wheel: timers that cost O(1) to schedule and to cancel.
+
+Time is cut into ticks of a fixed length. A timer goes into the slot of the
+tick it is due in, modulo the number of slots, so scheduling and cancelling
+are a dict insert and delete whatever the delay. advance() visits the slots
+of the ticks that have passed and fires the timers in them that are due;
+timers a whole turn of the wheel or more away wait for a later turn. An
+event loop that sleeps no longer than timeout() fires timers at most one
+tick late, and never early.
+"""
+import math
+import time
+from operator import attrgetter
+
+
+__all__ = [
+    "Timer",
+    "TimerWheel",
+]
+
+
+class Timer:
+    """A scheduled call, returned by TimerWheel.schedule."""
+
+    __slots__ = ('due', 'callback', 'args')
+
+    def __init__(self, due, callback, args):
+        self.due = due  # Number of the tick the timer fires in
+        self.callback = callback
+        self.args = args
+
+
+class TimerWheel:
+    """Timers with a resolution of tick seconds, on the monotonic clock."""
+
+    def __init__(self, tick: float = 0.1, slots: int = 512):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]  # Dicts used as insertion-ordered sets of timers
+        self.current = self._tick_at(time.monotonic())  # Last tick advance() has handled
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _tick_at(self, now: float) -> int:
+        return int(now / self.tick)
+
+    def schedule(self, delay: float, callback, *args) -> Timer:
+        """Call callback(*args) from advance() once delay seconds have passed"""
+        due = max(math.ceil((time.monotonic() + delay) / self.tick), self.current + 1)
+        timer = Timer(due, callback, args)
+        self.slots[due % len(self.slots)][timer] = None
+        self.count += 1
+        return timer
+
+    def cancel(self, timer: Timer):
+        """Stop a timer. Does nothing for None or a timer that has fired or been cancelled"""
+        if timer is None:
+            return
+        slot = self.slots[timer.due % len(self.slots)]
+        if timer in slot:
+            del slot[timer]
+            self.count -= 1
+
+    def timeout(self):
+        """Seconds until the next tick, or None when no timer is scheduled"""
+        if not self.count:
+            return None
+        return max(0.0, (self.current + 1) * self.tick - time.monotonic())
+
+    def advance(self) -> int:
+        """Fire every timer that is due. Returns how many fired.
+
+        Timers that callbacks schedule are due in a later tick, so they
+        wait for the next call.
+        """
+        now = self._tick_at(time.monotonic())
+        if now <= self.current or not self.count:
+            self.current = max(now, self.current)
+            return 0
+        slot_count = len(self.slots)
+        due = []
+        # After a stall of a whole turn or more, one pass over every slot finds everything due
+        for tick in range(max(self.current + 1, now - slot_count + 1), now + 1):
+            slot = self.slots[tick % slot_count]
+            if slot:
+                due.extend(timer for timer in slot if timer.due <= now)
+        due.sort(key=attrgetter('due'))  # Only out of order after a stall
+        self.current = now
+        fired = 0
+        for timer in due:
+            slot = self.slots[timer.due % slot_count]
+            if timer in slot:  # Not cancelled by an earlier callback
+                del slot[timer]
+                self.count -= 1
+                fired += 1
+                timer.callback(*timer.args)
+        return fired
@@ -0,0 +1,244 @@
+import sys
+import json
+import logging
+import os
+import sqlite3
+
+
+__all__ = [
+    "JsonUserStore",
+    "SqliteUserStore",
+    "open_user_store",
+    "migrate_json_users",
+    "iter_json_array",
+]
+
+
+logger = logging.getLogger("server.auth")
+
+
+class JsonUserStore:
+    """Users kept in memory by username and persisted as a JSON list.
+
+    This is the original users.json format. Every registration rewrites
+    the whole file, so prefer SqliteUserStore for large user bases.
+    """
+
+    def __init__(self, user_file):
+        self.user_file = os.path.expanduser(user_file)
+        self.users = {}
+        if not os.path.exists(self.user_file):
+            self.save()
+            return
+        try:
+            for user in load_json_users(self.user_file):
+                self.users.setdefault(user['username'], user)  # First entry wins
+        except ValueError:  # Includes json.JSONDecodeError
+            print(f"Error: {self.user_file} is not in a valid JSON format.")
+            sys.exit(1)
+
+    def get(self, username):
+        """Look up a user record by username, or None if there is no such user."""
+        return self.users.get(username)
+
+    def add(self, username, hashed_password):
+        """Store a new user. Returns False if the username is taken."""
+        if username in self.users:
+            return False
+        self.users[username] = {"username": username, "password": hashed_password}
+        self.save()
+        return True
+
+    def save(self):
+        # Write a temporary file and swap it in so a crash never leaves a truncated database
+        temp_file = self.user_file + ".tmp"
+        try:
+            with open(temp_file, 'w') as file:
+                json.dump(list(self.users.values()), file, indent=4)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_file, self.user_file)
+        except Exception as e:
+            logger.error("Error saving users: %s", e)
+
+    def __len__(self):
+        return len(self.users)
+
+    def close(self):
+        pass
+
+
+class SqliteUserStore:
+    """Users stored in a SQLite database in WAL mode.
+
+    Registrations are single-row inserts and lookups use the primary key
+    index, so neither depends on the number of users.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = os.path.expanduser(db_file)
+        self.db = sqlite3.connect(self.db_file)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "username TEXT PRIMARY KEY, "
+            "password TEXT NOT NULL)"
+        )
+        self.db.commit()
+
+    def get(self, username):
+        """Look up a user record by username, or None if there is no such user."""
+        row = self.db.execute(
+            "SELECT username, password FROM users WHERE username = ?", (username,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {"username": row[0], "password": row[1]}
+
+    def add(self, username, hashed_password):
+        """Store a new user. Returns False if the username is taken."""
+        try:
+            with self.db:
+                self.db.execute(
+                    "INSERT INTO users (username, password) VALUES (?, ?)",
+                    (username, hashed_password)
+                )
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def add_many(self, users):
+        """Insert user records in one transaction, skipping names already present."""
+        with self.db:
+            cursor = self.db.executemany(
+                "INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)",
+                ((user['username'], user['password']) for user in users)
+            )
+        return cursor.rowcount
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+
+def iter_json_array(file, chunk_size=64 * 1024):
+    """Yield the elements of a top-level JSON array one at a time.
+
+    Only the current chunk of the file is held in memory, so large user
+    databases load without first building the whole list.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def read_more():
+        nonlocal buffer, pos, eof
+        chunk = file.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    def skip_whitespace():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            read_more()
+
+    skip_whitespace()
+    if pos >= len(buffer):
+        return  # An empty file holds no users
+    if buffer[pos:pos + 1] != "[":
+        raise ValueError("Invalid JSON structure")
+    pos += 1
+    expect_value = first = True
+    while True:
+        skip_whitespace()
+        if pos >= len(buffer):
+            raise json.JSONDecodeError("Unterminated array", buffer, pos)
+        char = buffer[pos]
+        if char == "]" and (not expect_value or first):
+            return
+        if char == "," and not expect_value:
+            pos += 1
+            expect_value = True
+            continue
+        if not expect_value:
+            raise json.JSONDecodeError("Expecting ',' delimiter", buffer, pos)
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            read_more()
+            continue
+        # A value is only complete once a delimiter follows it in the buffer:
+        # "2." at the end of a chunk decodes as 2 but may be the start of 2.5
+        following = end
+        while following < len(buffer) and buffer[following].isspace():
+            following += 1
+        if not eof and (following == len(buffer) or buffer[following] not in ",]"):
+            read_more()
+            continue
+        pos = end
+        expect_value = first = False
+        yield value
+
+
+def load_json_users(user_file):
+    """Yield the valid user records of a users.json file."""
+    with open(user_file, 'r') as file:
+        for user in iter_json_array(file):
+            if isinstance(user, dict) and 'username' in user and 'password' in user:
+                yield user
+
+
+def migrate_json_users(user_file, store, batch_size=10000):
+    """Copy every user from a users.json file into a SQLite store.
+
+    Users already in the store are left untouched. Returns the number added.
+    """
+    user_file = os.path.expanduser(user_file)
+    added = 0
+    batch = []
+    try:
+        for user in load_json_users(user_file):
+            batch.append(user)
+            if len(batch) >= batch_size:
+                added += store.add_many(batch)
+                batch.clear()
+    except ValueError:  # Includes json.JSONDecodeError
+        print(f"Error: {user_file} is not in a valid JSON format.")
+        sys.exit(1)
+    if batch:
+        added += store.add_many(batch)
+    return added
+
+
+def open_user_store(config):
+    """Open the user store selected by the userStorage config key."""
+    if config.get('userStorage', 'json') == 'sqlite':
+        store = SqliteUserStore(config['userDatabase'])
+        migrate_from = config.get('userMigrateFrom')
+        # Only import into an empty database so restarts do not rescan the JSON file
+        if migrate_from and os.path.exists(os.path.expanduser(migrate_from)) and len(store) == 0:
+            added = migrate_json_users(migrate_from, store)
+            if added:
+                logger.info("Migrated %d user(s) from %s", added, migrate_from)
+        return store
+    return JsonUserStore(config['userDatabase'])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python userstore.py <users.json> <users.db>")
+        sys.exit(1)
+    store = SqliteUserStore(sys.argv[2])
+    print(f"Migrated {migrate_json_users(sys.argv[1], store)} user(s) into {sys.argv[2]}")
+    store.close()